@@ -9,4 +9,5 @@
 
 /* Then create the views */
 \i sql/view_definitions/create_view_schedule_per_team.sql
-\i sql/view_definitions/create_view_game_count_per_team_per_week.sql
\ No newline at end of file
+\i sql/view_definitions/create_view_game_count_per_team_per_week.sql
+\i sql/view_definitions/create_materialized_view_league_percentage_averages.sql
\ No newline at end of file
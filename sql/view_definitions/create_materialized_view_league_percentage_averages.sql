@@ -0,0 +1,24 @@
+/* DDL for a materialized view of the per-team league averages used to calculate the percentage impacts.
+   It only changes when new game logs are loaded, so it's refreshed then instead of being re-aggregated
+   from the whole game_log table every time the players are evaluated.
+   The sums are divided by 30 because there are 30 teams in the NBA, so these are the average makes/attempts per team */
+CREATE MATERIALIZED VIEW IF NOT EXISTS league_percentage_averages AS
+WITH averages AS (
+    SELECT
+        SUM(field_goals) / 30 AS avg_field_goals,
+        SUM(field_goal_attempts) / 30 AS avg_field_goal_attempts,
+        SUM(free_throws) / 30 AS avg_free_throws,
+        SUM(free_throw_attempts) / 30 AS avg_free_throw_attempts
+    FROM
+        game_log
+)
+SELECT
+    avg_field_goals,
+    avg_field_goal_attempts,
+    avg_field_goals::real / avg_field_goal_attempts::real AS avg_field_goal_percentage,
+    avg_free_throws,
+    avg_free_throw_attempts,
+    avg_free_throws::real / avg_free_throw_attempts::real AS avg_free_throw_percentage
+FROM
+    averages
+;
@@ -2,28 +2,96 @@
 """
 Script to scrape the stats and salaries of NBA players from Basketball Reference and load them into a postgres database
 """
-from bs4 import BeautifulSoup
+from lxml import etree
+import lxml.html
 from urllib.request import urlopen
-import src.query_tool as query_tool
-
-
-def fix_percentages(record):
+from src.utils.page_cache import get_cached_page
+from src.utils.query_tool import QueryTool
+
+query_tool = QueryTool()
+
+# Maps the columns of the players table to the headers scraped from Basketball Reference
+STATS_COLUMNS = {
+    "player_name": "Player",
+    "position": "Pos",
+    "team": "Tm",
+    "games_played": "G",
+    "games_started": "GS",
+    "minutes_played": "MP",
+    "field_goals": "FG",
+    "field_goal_attempts": "FGA",
+    "free_throws": "FT",
+    "free_throw_attempts": "FTA",
+    "three_pointers": "3P",
+    "points": "PTS",
+    "rebounds": "TRB",
+    "assists": "AST",
+    "steals": "STL",
+    "blocks": "BLK",
+    "turnovers": "TOV",
+}
+
+# Maps the columns of the salaries table to the headers scraped from Basketball Reference
+SALARIES_COLUMNS = {
+    "player_name": "Player",
+    "team": "Tm",
+    "salary": "salary",
+}
+
+# Translation table that deletes the '$' and ',' from a salary like '$1,234,567'
+SALARY_CHARS = str.maketrans("", "", "$,")
+
+
+def fix_percentages(record, indexes):
     """
     If a player has no FG or FT attempts Basketball Reference has their FG% and FT% as '',
     but we need a number for loading the data into postgres
-    :param record: The record scraped from Basketball Reference
+    :param record: The list of values scraped from Basketball Reference for a single player
+    :param indexes: The positions of the FG and FT values in the record
     :return: The modified record
     """
-    for key in ('FT', 'FG'):
-        if record[key] == '':
-            record[key] = 0
+    for index in indexes:
+        record[index] = record[index] or 0
     return record
 
 
+def get_html(url):
+    """Get the parsed HTML for the provided page, from the page cache if it was already scraped today
+
+    :param url: The URL of the page you want
+    :return: The root element of the page
+    """
+    html = get_cached_page(url, lambda: urlopen(url).read())
+    return lxml.html.fromstring(html)
+
+
+def data_stat_predicate(fields):
+    """Build an XPath predicate that matches the cells whose data-stat is one of the given fields
+
+    :param fields: The data-stat values of the cells you want to match
+    :return: The XPath predicate
+    """
+    return " or ".join(f"@data-stat='{field}'" for field in fields)
+
+
+def data_stat_xpath(tag, fields):
+    """Build a compiled XPath that selects the child elements of a row whose data-stat is one of the given fields
+
+    :param tag: The tag of the cells you want to select, i.e. 'th' or 'td'
+    :param fields: The data-stat values of the cells you want to select
+    :return: The compiled XPath, which can be called on a row element
+    """
+    return etree.XPath(f"./{tag}[{data_stat_predicate(fields)}]")
+
+
 def scrape_stats(year):
+    """Scrape the season stat totals of every player from Basketball Reference
+
+    :param year: The year in which the NBA season ends
+    :return: A generator of tuples, one per player, with the values for each column in STATS_COLUMNS
+    """
     url = f"https://www.basketball-reference.com/leagues/NBA_{year}_totals.html"
-    html = urlopen(url)
-    soup = BeautifulSoup(html, features="lxml")
+    tree = get_html(url)
 
     desired_fields = (
         "player",  # player name
@@ -45,12 +113,18 @@ def scrape_stats(year):
         "tov",  # turnovers
     )
 
-    headers = [th.getText().strip('%') for th in soup.find_all('tr', limit=2)[0].find_all('th', attrs={'data-stat': desired_fields})]
-    rows = soup.find_all('tr', {'class': 'full_table'})
-    player_stats = [[td.getText() for td in row.find_all('td', attrs={'data-stat': desired_fields})]
-                    for row in rows]
+    header_cells = data_stat_xpath("th", desired_fields)
+    data_cells = data_stat_xpath("td", desired_fields)
+
+    headers = [th.text_content().strip('%') for th in header_cells(tree.xpath("(//tr)[1]")[0])]
+    # The rows are emitted as tuples in the same order as STATS_COLUMNS, ready to be fed straight to COPY
+    column_indexes = [headers.index(header) for header in STATS_COLUMNS.values()]
+    percentage_indexes = [headers.index(header) for header in ('FT', 'FG')]
 
-    return [fix_percentages(dict(zip(headers, player))) for player in player_stats]
+    rows = tree.xpath("//tr[contains(concat(' ', normalize-space(@class), ' '), ' full_table ')]")
+    for row in rows:
+        player = fix_percentages([td.text_content() for td in data_cells(row)], percentage_indexes)
+        yield tuple(player[index] for index in column_indexes)
 
 
 def convert_salary(record):
@@ -59,83 +133,40 @@ def convert_salary(record):
     :param record: A record scraped from the Basketball Reference salary page
     :return: The record with the updated salary
     """
-    record[2] = int(record[2].strip('$').replace(',', ''))
+    record[2] = int(record[2].translate(SALARY_CHARS))
     return record
 
 
 def scrape_salaries():
     url = "https://www.basketball-reference.com/contracts/players.html"
-    html = urlopen(url)
-    soup = BeautifulSoup(html, features="lxml")
+    tree = get_html(url)
 
     desired_fields = ('y1', 'player', 'team_id')
+    predicate = data_stat_predicate(desired_fields)
 
-    headers = [th.getText() for th in soup.find_all('tr', limit=2)[1].find_all('th', attrs={'data-stat': desired_fields})]
+    headers = [th.text_content() for th in tree.xpath(f"(//tr)[2]/th[{predicate}]")]
     # third header is the salary for 'y1' but since we're ignoring the rest of the years we can just call it salary
     headers[2] = "salary"
-    rows = soup.find_all('tr')[2:]
-    salaries = [[td.getText() for td in row.find_all('td', attrs={'data-stat': desired_fields})]
-                for row in rows]
 
-    return [dict(zip(headers, convert_salary(salary))) for salary in salaries if len(salary) > 0]
+    # A row that's missing any of the desired fields is skipped, since there'd be no telling which value is which
+    num_fields = len(desired_fields)
+    cells_xpath = etree.XPath(f"td[{predicate}]")
+    salaries = []
+    for row in tree.xpath("(//tr)[position() > 2][td]"):
+        cells = [td.text_content() for td in cells_xpath(row)]
+        if len(cells) == num_fields:
+            salaries.append(cells)
+
+    return [dict(zip(headers, convert_salary(salary))) for salary in salaries]
 
 
 def load_stats(stats):
-    query = """
-    insert into players(
-        player_name, 
-        position, 
-        team, 
-        games_played, 
-        games_started, 
-        minutes_played,
-        field_goals,
-        field_goal_attempts,
-        free_throws,
-        free_throw_attempts,
-        three_pointers,
-        points,
-        rebounds,
-        assists,
-        steals,
-        blocks,
-        turnovers
-    ) values (
-        %(Player)s,
-        %(Pos)s,
-        %(Tm)s,
-        %(G)s,
-        %(GS)s,
-        %(MP)s,
-        %(FG)s,
-        %(FGA)s,
-        %(FT)s,
-        %(FTA)s,
-        %(3P)s,
-        %(PTS)s,
-        %(TRB)s,
-        %(AST)s,
-        %(STL)s,
-        %(BLK)s,
-        %(TOV)s
-    );
-    """
-    query_tool.insert(query, stats)
+    query_tool.copy("players", list(STATS_COLUMNS), stats)
 
 
 def load_salaries(salaries):
-    query = """
-    insert into salaries(
-        player_name,
-        team,
-        salary
-    ) values (
-        %(Player)s,
-        %(Tm)s,
-        %(salary)s
-    );
-    """
-    query_tool.insert(query, salaries)
+    rows = ([record[header] for header in SALARIES_COLUMNS.values()] for record in salaries)
+    query_tool.copy("salaries", list(SALARIES_COLUMNS), rows)
 
 
 def main():
@@ -1,3 +1,5 @@
+import numpy as np
+
 from src.utils.player_evaluator import PlayerEvaluator
 
 if __name__ == "__main__":
@@ -18,68 +20,62 @@ if __name__ == "__main__":
         end_date="2023-12-31",
         use_totals=False
     )
+    # Everything below works on indexes into the players list, so each value
+    # only has to be pulled out of the player dicts once
+    stats = tuple(weights)
+    stats_matrix = np.array([[p[stat] for stat in stats] for p in players])
+    relative_values = np.array([p["relative_value"] for p in players])
+    salaries = np.array([p["salary"] for p in players])
+
     rosters = {}
-    totals = {}
-    for player in players:
+    for i, player in enumerate(players):
         rosters.setdefault(player["manager"], [])
-        rosters[player["manager"]].append(player)
+        rosters[player["manager"]].append(i)
 
     my_team = rosters.pop("Danny")
-    free_agents = rosters.pop(None)
+    free_agents = np.array(rosters.pop(None))
+
+    # My team goes first, then everyone else's alphabetically by manager
+    teams = {"Danny": my_team, **dict(sorted(rosters.items()))}
+    # Each team's stat totals are summed in a single pass over its players,
+    # instead of one pass over the team per stat
+    managers = np.array(list(teams))
+    team_totals = np.array([stats_matrix[team].sum(axis=0) for team in teams.values()])
 
-    print("--- My Team ---")
-    for player in sorted(my_team, key=lambda x: x["relative_value"], reverse=True):
+    def rank(indexes, values):
+        """Sort the player indexes by the given values, from highest to lowest"""
+        return indexes[np.argsort(-values[indexes], kind="stable")]
+
+    def print_player(i):
+        """Print the line summarizing the player at the given index"""
+        player = players[i]
         print(
             f"{player['player_name']}   |   {player['relative_value']:.2f}   |   "
             f"${player['salary']:,}    |    {player['minutes_per_game']:.2f}    |    {player['status'] or ''}"
         )
 
-    for stat in weights.keys():
-        totals.setdefault(stat, [])
-        totals[stat].append({"manager": "Danny", "total": sum(p[stat] for p in my_team)})
-
-    print("\n")
-
-    for manager, players in sorted(rosters.items()):
-        print(f"--- {manager}'s Team ---")
-        team = sorted(
-            players,
-            key=lambda x: x["relative_value"],
-            reverse=True
-        )
-        for player in team:
-            print(
-                f"{player['player_name']}   |   {player['relative_value']:.2f}   |   "
-                f"${player['salary']:,}    |    {player['minutes_per_game']:.2f}    |    {player['status'] or ''}"
-            )
-
-        for stat in weights.keys():
-            totals[stat].append({"manager": manager, "total": sum(p[stat] for p in team)})
+    for manager, team in teams.items():
+        print("--- My Team ---" if manager == "Danny" else f"--- {manager}'s Team ---")
+        for i in rank(np.array(team), relative_values):
+            print_player(i)
         print("\n")
 
-    for stat, values in totals.items():
+    for stat_index, stat in enumerate(stats):
         print(f"\n--- {stat} ---")
-        for value in sorted(values, key=lambda x: x["total"], reverse=True):
-            print(f"{value['manager']}: {value['total']:.2f}")
+        stat_totals = team_totals[:, stat_index]
+        for team_index in np.argsort(-stat_totals, kind="stable"):
+            print(f"{managers[team_index]}: {stat_totals[team_index]:.2f}")
 
     print("\n--- Summary Stats of Player Value ---")
-    from statistics import median
-
-    print("Max: " + str(max(p["relative_value"] for p in free_agents)))
-    print("Median: " + str(median(p["relative_value"] for p in free_agents)))
+    print("Max: " + str(relative_values[free_agents].max()))
+    print("Median: " + str(np.median(relative_values[free_agents])))
 
     print("\n--- Free Agents ---")
-    free_agents = sorted(
-        free_agents,
-        key=lambda x: x["relative_value"],
-        reverse=True
-    )
-    for player in free_agents[:100]:
-        print(f"{player['player_name']}   |   {player['relative_value']:.2f}   |   "
-             f"${player['salary']:,}    |    {player['minutes_per_game']:.2f}    |    {player['status'] or ''}")
-        # print(player)
+    free_agents = rank(free_agents, relative_values)
+    for i in free_agents[:100]:
+        print_player(i)
 
     print("\n--- High Value Players ---")
-    for player in sorted(free_agents, key=lambda x: x["relative_value"] / (x["salary"] / 1_000_000), reverse=True)[:50]:
-        print(f"{player['player_name']}   |   {player['relative_value']:.2f}   |   "
-              f"${player['salary']:,}    |    {player['minutes_per_game']:.2f}    |    {player['status'] or ''}")
+    value_per_million = relative_values / (salaries / 1_000_000)
+    for i in rank(free_agents, value_per_million)[:50]:
+        print_player(i)
@@ -1,13 +1,13 @@
 """This script should be run at the beginning of the Fantasy Basketball season"""
 
 from src.utils.data_loader import DataLoader
-from src.utils.query_tool import QueryTool
 
 
 class FantasySeasonInitializer:
     def __init__(self):
         self.data_loader = DataLoader()
-        self.query_tool = QueryTool()
+        # Share the data loader's query tool so that all of the loads can run in its transaction
+        self.query_tool = self.data_loader.query_tool
 
     def _clean_database(self) -> None:
         """Clean the database at the beginning of a season
@@ -29,13 +29,14 @@ class FantasySeasonInitializer:
         data that we get from Yahoo. Lastly we upload the NBA schedule from Basketball Reference
         and the player salaries from Spotrac
 
+        Everything runs in a single transaction on one connection, so if any of the loads fail
+        the database is left the way it was instead of half cleaned
         """
-        self._clean_database()
-        self.data_loader.load_players_and_nba_teams()
-        self.data_loader.load_teams_and_rosters()
-        self.data_loader.load_matchups()
-        self.data_loader.load_schedule()
-        self.data_loader.load_salaries()
+        with self.query_tool.transaction():
+            self._clean_database()
+            self.data_loader.load_players_teams_and_rosters()
+            self.data_loader.load_matchups()
+            self.data_loader.load_schedule_and_salaries()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,12 @@
 """This script updates the players and rosters tables and will upload any new game logs"""
 from src.utils.data_loader import DataLoader
-from src.utils.query_tool import QueryTool
 
 
 class MidSeasonUpdater:
     def __init__(self):
-        self.query_tool = QueryTool()
         self.data_loader = DataLoader()
+        # Share the data loader's query tool rather than building a second one
+        self.query_tool = self.data_loader.query_tool
 
     def _clean_rosters(self) -> None:
         """Clean the rosters table before they are re-uploaded from Yahoo"""
@@ -25,7 +25,8 @@ class MidSeasonUpdater:
             - Loading any new game logs
         """
         self._clean_rosters()
-        self.data_loader.load_players_and_nba_teams()
+        # The whole point is to pick up the players' latest statuses, so they can't come from the cache
+        self.data_loader.load_players_and_nba_teams(use_cache=False)
         self.data_loader.load_salaries()
         self.data_loader.load_teams_and_rosters()
         self.data_loader.load_game_logs()
@@ -13,58 +13,210 @@ and the chosen players are printed out at the end.
 
 from mip import *
 
-from typing import Dict, Any, List
+from bisect import bisect_right, insort
+from heapq import nlargest
+from typing import Dict, Any, List, Tuple
 from src.utils.player_evaluator import PlayerEvaluator
 
 SALARY_CAP = 173_000_000
+TEAM_SIZE = 12
+# The minimum and maximum number of players on the team who can play each position
+POSITION_BOUNDS = {
+    # We can have between 1 and 6 point/shooting guards (PG/SG, G, Util, Util, Bench, Bench)
+    # but I want at least 2 of each position for roster flexibility
+    "PG": (2, 6),
+    "SG": (2, 6),
+    # Same for small/power forwards
+    "SF": (2, 6),
+    "PF": (2, 6),
+    # We can have between 2 and 6 centers, but I want at least three for more roster flexibility
+    "C": (3, 6),
+}
 
 
-def pick_players(players: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Function to determine which players you should pick for your fantasy basketball team!
+def linear_sum(variables: List[Var], coeffs: List[float] = None) -> LinExpr:
+    """Function to build the weighted sum of the given variables as a single linear expression
 
-    Sets up the optimization model with salary-cap, position, and team-size constraints and determines
-    the best 12 players based on 'relative_value' that fit the constraints
+    Unlike `xsum`, which builds up the expression one term at a time and creates a new expression for every
+    `coeff * var` product, this hands all the variables and coefficients to the expression at once.
 
-    :param players: The list of players
-    :return: Your fantasy basketball team!
+    :param variables: The variables in the sum
+    :param coeffs: The coefficient of each variable. If not supplied, every coefficient is 1
+    :return: The linear expression
     """
+    variables = list(variables)
+    if coeffs is None:
+        coeffs = [1.0] * len(variables)
+    return LinExpr(variables=variables, coeffs=list(coeffs))
 
-    m = Model(sense=MAXIMIZE)
-    x = [m.add_var(var_type=BINARY) for _ in range(len(players))]
 
-    # salary cap constraint
-    m += xsum(players[i]['salary'] * x[i] for i in range(len(players))) <= SALARY_CAP
-    # 12 players on the team constraint
-    m += xsum(1 * x[i] for i in range(len(players))) == 12
+def remove_dominated_players(players: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Function to remove the players that can never be part of an optimal team
 
-    # We can have between 1 and 6 point/shooting guards (PG/SG, G, Util, Util, Bench, Bench)
-    # but I want at least 2 of each position for roster flexibility
-    m += xsum(('PG' in players[i]['position']) * x[i] for i in range(len(players))) >= 2
-    m += xsum(('PG' in players[i]['position']) * x[i] for i in range(len(players))) <= 6
+    A player is dominated if there are at least TEAM_SIZE other players with the exact same positions
+    who are at least as valuable and no more expensive. Any team with that player on it is missing at least
+    one of those other players, who could be swapped in without breaking any constraints or lowering the
+    team's value. So leaving the dominated players out of the model doesn't change the best team it can find,
+    it just makes the model smaller.
 
-    m += xsum(('SG' in players[i]['position']) * x[i] for i in range(len(players))) >= 2
-    m += xsum(('SG' in players[i]['position']) * x[i] for i in range(len(players))) <= 6
+    :param players: The list of players
+    :return: The players that aren't dominated, in the same order as they were given
+    """
+    groups = {}
+    for i, player in enumerate(players):
+        groups.setdefault(player['positions'], []).append(i)
+
+    keep = set()
+    for group in groups.values():
+        # Going from most to least valuable, everyone already seen is at least as valuable as the current player,
+        # so the number of them who are no more expensive is the number of players that dominate them
+        group.sort(key=lambda i: (-players[i]['relative_value'], players[i]['salary']))
+        seen_salaries = []
+        for i in group:
+            salary = players[i]['salary']
+            if bisect_right(seen_salaries, salary) < TEAM_SIZE:
+                keep.add(i)
+            insort(seen_salaries, salary)
+
+    return [player for i, player in enumerate(players) if i in keep]
+
+
+def pick_greedy_team(
+        players: List[Dict[str, Any]],
+        salary_cap: int = SALARY_CAP,
+        position_bounds: Dict[str, Tuple[int, int]] = POSITION_BOUNDS
+) -> List[int]:
+    """Function to quickly pick a team that satisfies all the constraints, though probably not the best one
+
+    Goes through the players from most to least valuable, taking everyone who fits under the salary cap and
+    position maximums, as long as the open roster spots can still cover every position minimum
+    and be filled by the cheapest player without going over the cap.
+    A feasible team gives the solver a lower bound on the objective right away, which lets it
+    skip any part of the search that can't beat it.
 
-    # Same for small/power forwards
-    m += xsum(('SF' in players[i]['position']) * x[i] for i in range(len(players))) >= 2
-    m += xsum(('SF' in players[i]['position']) * x[i] for i in range(len(players))) <= 6
+    :param players: The list of players
+    :param salary_cap: The most the team's salaries can add up to
+    :param position_bounds: The minimum and maximum number of players on the team for each position
+    :return: The indexes of the players on the team, or an empty list if no complete team was found
+    """
+    if not players:
+        return []
+
+    team = []
+    total_salary = 0
+    position_counts = dict.fromkeys(position_bounds, 0)
+    min_salary = min(player['salary'] for player in players)
+    for i in sorted(range(len(players)), key=lambda i: players[i]['relative_value'], reverse=True):
+        player = players[i]
+        open_spots = TEAM_SIZE - len(team) - 1
+        if total_salary + player['salary'] + open_spots * min_salary > salary_cap:
+            continue
+
+        counts = {position: count + (position in player['positions']) for position, count in position_counts.items()}
+        if any(counts[position] > maximum for position, (_, maximum) in position_bounds.items()):
+            continue
+
+        shortfall = sum(max(minimum - counts[position], 0) for position, (minimum, _) in position_bounds.items())
+        if shortfall > open_spots:
+            continue
+
+        team.append(i)
+        total_salary += player['salary']
+        position_counts = counts
+        if len(team) == TEAM_SIZE:
+            return team
+
+    return []
+
+
+def build_model(
+        players: List[Dict[str, Any]],
+        salary_cap: int = SALARY_CAP,
+        position_bounds: Dict[str, Tuple[int, int]] = POSITION_BOUNDS
+) -> Model:
+    """Function to set up the optimization model for picking a team out of the given players
+
+    The model has one binary variable per player, in the same order as the players, which is 1 if
+    that player is on the team. It comes with salary-cap, position, and team-size constraints,
+    an objective that maximizes the team's total 'relative_value', and a greedy team as its starting solution
 
-    m += xsum(('PF' in players[i]['position']) * x[i] for i in range(len(players))) >= 2
-    m += xsum(('PF' in players[i]['position']) * x[i] for i in range(len(players))) <= 6
+    :param players: The list of players
+    :param salary_cap: The most the team's salaries can add up to
+    :param position_bounds: The minimum and maximum number of players on the team for each position
+    :return: The model, ready to be optimized
+    """
+    m = Model(sense=MAXIMIZE, solver_name=CBC)
+    # CBC's progress log is written to stdout and isn't useful for a problem this small
+    m.verbose = 0
+    # All the binary variables are created in a single call to the solver instead of one call per player
+    x = m.add_var_tensor((len(players),), "x", var_type=BINARY)
+
+    # Pull the coefficients out of the player dicts once, rather than in every expression that uses them
+    salaries = [player['salary'] for player in players]
+    relative_values = [player['relative_value'] for player in players]
+
+    # Check each player's positions once up front instead of once per position constraint.
+    # The position constraints then only need terms for the players who can play that position.
+    # This is a single pass over the players, only looking at the positions each player actually has
+    position_indexes = {position: [] for position in position_bounds}
+    for i, player in enumerate(players):
+        for position in player['positions']:
+            if position in position_indexes:
+                position_indexes[position].append(i)
 
-    # We can have between 2 and 6 centers, but I want at least three for more roster flexibility
-    m += xsum(('C' in players[i]['position']) * x[i] for i in range(len(players))) >= 3
-    m += xsum(('C' in players[i]['position']) * x[i] for i in range(len(players))) <= 6
+    # salary cap constraint
+    m += linear_sum(x, salaries) <= salary_cap
+    # 12 players on the team constraint
+    m += linear_sum(x) == TEAM_SIZE
+
+    # Cover cut: if the k most expensive players plus the cheapest players to fill out the rest of the team
+    # are already over the salary cap, at most k - 1 of those expensive players can be on the team.
+    # It's implied by the two constraints above, but the LP relaxation can't see it on its own
+    by_salary = sorted(range(len(players)), key=salaries.__getitem__)
+    for k in range(1, TEAM_SIZE + 1):
+        most_expensive = by_salary[-k:]
+        cheapest = by_salary[:TEAM_SIZE - k]
+        if sum(salaries[i] for i in most_expensive + cheapest) > salary_cap:
+            m += linear_sum(x[i] for i in most_expensive) <= k - 1
+            break
+
+    for position, (minimum, maximum) in position_bounds.items():
+        # Both bounds share the same expression, which is copied when each constraint is made
+        position_sum = linear_sum(x[i] for i in position_indexes[position])
+        m += position_sum >= minimum
+        m += position_sum <= maximum
+
+    m.objective = linear_sum(x, relative_values)
+
+    greedy_team = pick_greedy_team(players, salary_cap, position_bounds)
+    if greedy_team:
+        m.start = [(x[i], 1.0) for i in greedy_team]
+
+    return m
+
+
+def pick_players(
+        players: List[Dict[str, Any]],
+        salary_cap: int = SALARY_CAP,
+        position_bounds: Dict[str, Tuple[int, int]] = POSITION_BOUNDS
+) -> List[Dict[str, Any]]:
+    """Function to determine which players you should pick for your fantasy basketball team!
 
-    m.objective = xsum(players[i]['relative_value'] * x[i] for i in range(len(players)))
-    m.optimize()
+    Sets up the optimization model with salary-cap, position, and team-size constraints and determines
+    the best 12 players based on 'relative_value' that fit the constraints
+
+    :param players: The list of players
+    :param salary_cap: The most the team's salaries can add up to
+    :param position_bounds: The minimum and maximum number of players on the team for each position
+    :return: Your fantasy basketball team!
+    """
+    players = remove_dominated_players(players)
 
-    team_members = []
-    for i, var in enumerate(m.vars):
-        if round(var.x, 2) == 1.0:
-            team_members.append(players[i])
+    m = build_model(players, salary_cap, position_bounds)
+    m.optimize()
 
-    return team_members
+    # The variables are binary, so anything past the halfway point is a 1 within the solver's tolerance
+    return [players[i] for i, var in enumerate(m.vars) if var.x >= 0.5]
 
 
 def main():
@@ -91,7 +243,7 @@ def main():
         print(player)
 
     print()
-    for player in sorted(players, key=lambda p: p['relative_value'], reverse=True)[:20]:
+    for player in nlargest(20, players, key=lambda p: p['relative_value']):
         print(player)
 
 
@@ -1,21 +1,42 @@
 from typing import List, Dict, Any, Optional
 
 import datetime
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
 
 from src.utils.query_tool import QueryTool
 
+# The per-game averages returned for each player, in the order they're used to build the projections
+STAT_KEYS = (
+    "field_goals",
+    "field_goal_attempts",
+    "free_throws",
+    "free_throw_attempts",
+    "three_pointers",
+    "points",
+    "rebounds",
+    "assists",
+    "steals",
+    "blocks",
+    "turnovers",
+)
+
 
 class MatchupProjector:
     def __init__(self):
         self.query_tool = QueryTool()
 
-    def _get_week_no(self) -> int:
-        """Get the week_no of *next week's matchup*
+    def _get_week_no(self, dte: datetime.date) -> int:
+        """Get the week_no of the matchup that the given date falls in
 
         Only run if the week number isn't provided by the user
+
+        :param dte: The date whose week_no you want
         """
         query = "SELECT week_no from match_ups where %(dte)s between week_start and week_end"
-        result = self.query_tool.select(query, {"dte": datetime.date.today() + datetime.timedelta(weeks=1)})
+        result = self.query_tool.select(query, {"dte": dte})
         return result[0]["week_no"]
 
     def _get_player_statistics(
@@ -33,17 +54,17 @@ class MatchupProjector:
         :return: The list of players who will be participating in the matchup, along with their relevant statistics.
             Each row is a single game log for a single player
         """
-        if start_date and end_date:
-            date_filter = "AND game_log.game_date BETWEEN %(start_date)s::DATE and %(end_date)s::DATE "
-
-        else:
-            date_filter = "AND game_log.game_date BETWEEN (SELECT get_season_start()) AND (SELECT get_season_end()) "
+        # Without both dates the whole season is used
+        if not (start_date and end_date):
+            start_date = end_date = None
 
+        # This is run as a prepared statement, so postgres only has to plan it once per connection
+        # rather than every time a week is projected
         query = (
-            "WITH participating_teams AS (SELECT team_id from match_ups where week_no = %(week_no)s "
+            "WITH participating_teams AS (SELECT team_id from match_ups where week_no = $1 "
             "UNION ALL SELECT team_id from teams where manager = 'Danny'), "
             "game_count AS (SELECT nba_team_id, count as num_games FROM game_count_per_team_per_week "
-            "WHERE week_no = %(week_no)s) "
+            "WHERE week_no = $1) "
             "SELECT player_name, team_name, game_count.num_games, status, "
             "AVG(field_goals) AS field_goals, AVG(field_goal_attempts) AS field_goal_attempts, "
             "AVG(free_throws) as free_throws, AVG(free_throw_attempts) as free_throw_attempts, "
@@ -56,39 +77,26 @@ class MatchupProjector:
             "JOIN teams using (team_id) "
             "JOIN game_count game_count using (nba_team_id) "
             "WHERE rosters.team_id in (SELECT team_id from participating_teams) "
-            f"{date_filter}"
+            "AND game_log.game_date BETWEEN COALESCE($2::DATE, (SELECT get_season_start())) "
+            "AND COALESCE($3::DATE, (SELECT get_season_end())) "
             "AND status IS DISTINCT FROM 'INJ' "
-            "GROUP BY player_name, team_name, num_games, status;"
+            "GROUP BY player_name, team_name, num_games, status "
+            "ORDER BY team_name, player_name"
         )
-        return self.query_tool.select(query, {"week_no": week_no, "start_date": start_date, "end_date": end_date})
+        return self.query_tool.select_prepared("get_player_statistics", query, (week_no, start_date, end_date))
 
     @staticmethod
     def _make_player_dict(statistics: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Take the list of rows from the database and turn it into a dict organized by team and player
 
-        :param statistics: The list of players and their statistics
+        :param statistics: The list of players and their statistics, sorted by team
         :return: A dict containing all the players. Looks like:
             {
                 "Fantasy Team 1": {
                     "Michael Jordan": {
                         "num_games": 4,  # this is the number of games the player is playing in the week you're checking
                         "status": None,
-                        "game_logs": [
-                            {
-                                "field_goals": 12,
-                                "field_goal_attempts": 16,
-                                "free_throws": 7,
-                                "free_throw_attempts": 8,
-                                "three_pointers": 2,
-                                "points": 33,
-                                "rebounds": 6,
-                                "assists": 5,
-                                "steals": 2,
-                                "blocks": 0,
-                                "turnovers": 4
-                            },
-                            ...
-                        ]
+                        "stats": (12.0, 16.0, 7.0, 8.0, 2.0, 33.0, 6.0, 5.0, 2.0, 0.0, 4.0)  # averages, in STAT_KEYS order
                     },
                     "Scottie Pippen: {
                         ...
@@ -100,20 +108,20 @@ class MatchupProjector:
                 }
             }
         """
-        player_dict = {}
-        for row in statistics:
-            team_name = row["team_name"]
-            player_dict.setdefault(team_name, {})
-            player_name = row["player_name"]
-            player_dict[team_name].setdefault(player_name, {})
-
-            player_dict[team_name][player_name]["num_games"] = row["num_games"]
-            player_dict[team_name][player_name]["status"] = row["status"]
-
-            player_dict[team_name][player_name].setdefault("stats", {})
-            player_dict[team_name][player_name]["stats"] = (
-                {k: v for k, v in row.items() if k not in ("player_name", "num_games", "status", "team_name")}
-            )
+        # The rows come back sorted by team, so each team's players can be grouped up in one go.
+        # The stats are picked out once per player, in STAT_KEYS order, so each player's
+        # row of the averages matrix in `_get_totals` is ready to use as is
+        player_dict = {
+            team: {
+                row["player_name"]: {
+                    "num_games": row["num_games"],
+                    "status": row["status"],
+                    "stats": tuple(row[stat] for stat in STAT_KEYS),
+                }
+                for row in rows
+            }
+            for team, rows in groupby(statistics, key=itemgetter("team_name"))
+        }
 
         return player_dict
 
@@ -124,14 +132,14 @@ class MatchupProjector:
         :param players: The players for a single fantasy team
         :return: A dict containing the totals for each stat, as well as field goal and free throw percentages
         """
-        totals = {"num_games": 0}
-        for player, data in players.items():
-            stats = data["stats"]
-            num_games = data["num_games"]
-            totals["num_games"] += num_games
-            for stat, average in stats.items():
-                totals.setdefault(stat, 0.0)
-                totals[stat] += float(average) * num_games
+        # Each player's projection is their averages times their number of games, so the team's projected
+        # totals are just the number of games vector times the matrix of averages
+        team = players.values()
+        averages = np.array([data["stats"] for data in team], dtype=np.float64)
+        num_games = np.array([data["num_games"] for data in team], dtype=np.float64)
+
+        totals = {"num_games": int(num_games.sum())}
+        totals.update(zip(STAT_KEYS, (num_games @ averages).tolist()))
 
         totals["field_goal_percentage"] = totals["field_goals"] / totals["field_goal_attempts"]
         totals["free_throw_percentage"] = totals["free_throws"] / totals["free_throw_attempts"]
@@ -147,7 +155,7 @@ class MatchupProjector:
             If not provided, will project next week's matchup
         """
         if not week_no:
-            week_no = self._get_week_no()
+            week_no = self._get_week_no(datetime.date.today() + datetime.timedelta(weeks=1))
         statistics = self._get_player_statistics(week_no, start_date="2023-10-01", end_date="2023-12-31")
         player_dict = self._make_player_dict(statistics)
         for team, players in player_dict.items():
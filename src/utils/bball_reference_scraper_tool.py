@@ -1,27 +1,111 @@
-from typing import List, Dict, Any
-from bs4 import BeautifulSoup
+from typing import List, Dict, Any, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
+import lxml.html
 from urllib.request import urlopen
-import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
+import threading
+import time
 
+from src.utils.page_cache import get_cached_page
 from src.utils.utils import sanitize_player_name
 
+BOX_SCORE_FIELDS = (
+    "fg",  # field goals made
+    "fga",  # field goal attempts
+    "ft",  # free throws made
+    "fta",  # free throw attempts
+    "fg3",  # three-pointers
+    "pts",  # points
+    "trb",  # total rebounds
+    "ast",  # assists
+    "stl",  # steals
+    "blk",  # blocks
+    "tov",  # turnovers
+)
+_BOX_SCORE_PREDICATE = " or ".join(f"@data-stat='{field}'" for field in BOX_SCORE_FIELDS)
+
+# The XPaths used on every box score are compiled once up front
+BOX_SCORE_HEADER_CELLS = etree.XPath(f"./thead/tr[2]/th[{_BOX_SCORE_PREDICATE}]")
+BOX_SCORE_ROWS = etree.XPath("./tbody/tr[not(contains(concat(' ', normalize-space(@class), ' '), ' thead '))]")
+BOX_SCORE_DATA_CELLS = etree.XPath(f"./td[{_BOX_SCORE_PREDICATE}]")
+
+# The schedule is the first table body on each month's page
+SCHEDULE_ROWS = etree.XPath("(//tbody)[1]/tr")
+SCHEDULE_GAME_DATE = etree.XPath("string(./th[@data-stat='date_game'])")
+SCHEDULE_HOME_TEAM = etree.XPath("string(./td[@data-stat='home_team_name'])")
+SCHEDULE_VISITING_TEAM = etree.XPath("string(./td[@data-stat='visitor_team_name'])")
+
 
 class BasketballReferenceWebScraper:
     BASKETBALL_REFERENCE_URL = "https://www.basketball-reference.com"
+    # Basketball Reference blocks anyone making more than 20 requests a minute, so stay a little under that
+    REQUESTS_PER_MINUTE = 18
+
+    def __init__(self):
+        # Reuse the same connections to Basketball Reference for every page instead of reconnecting per page.
+        # There's enough of them for every month of the schedule to be fetched at once, and a request
+        # that fails because Basketball Reference is having trouble gets retried instead of losing the page.
+        # If we do get rate limited anyway, the retry waits as long as the Retry-After header says to
+        self.session = requests.Session()
+        retries = Retry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=8, max_retries=retries))
+        self.session.headers["User-Agent"] = (
+            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) "
+            "Chrome/103.0.0.0 Safari/537.36"
+        )
+        # When each of the last REQUESTS_PER_MINUTE requests was made, shared by every thread scraping pages
+        self._request_times = deque(maxlen=self.REQUESTS_PER_MINUTE)
+        self._rate_limit_lock = threading.Lock()
+
+    def _wait_for_rate_limit(self) -> None:
+        """Block until another request can be made to Basketball Reference without going over the rate limit
 
-    def _get_parseable_html(self, url: str) -> BeautifulSoup:
-        """Helper function to get parseable HTML for the provided web page
+        Only actual requests count towards the limit, so pages that come from the page cache are never held up
+        """
+        with self._rate_limit_lock:
+            if len(self._request_times) == self.REQUESTS_PER_MINUTE:
+                wait = self._request_times[0] + 60 - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            self._request_times.append(time.monotonic())
+
+    def _get_page(self, url: str, max_age: Optional[datetime.timedelta] = datetime.timedelta(days=1)) -> bytes:
+        """Helper function to get the content of the provided web page, from the page cache if there's a fresh copy
 
         :param url: The basketball reference page from which you want to scrape data
-        :return: A BeautifulSoup object for parsing the HTML for the page you specified
+        :param max_age: How long a cached copy of the page is good for. If `None` it never expires
+        :return: The content of the page
         """
         full_url = f"{self.BASKETBALL_REFERENCE_URL}/{url}"
-        html = requests.get(
-            full_url, headers={"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Safari/537.36"}
-        ).content.decode("utf-8")
-        return BeautifulSoup(html, features="lxml")
+
+        def download() -> bytes:
+            self._wait_for_rate_limit()
+            response = self.session.get(full_url)
+            # Raise instead of caching an error page in place of the real one
+            response.raise_for_status()
+            return response.content
+
+        return get_cached_page(full_url, download, max_age=max_age)
+
+    def _get_html_tree(
+            self,
+            url: str,
+            max_age: Optional[datetime.timedelta] = datetime.timedelta(days=1)
+    ) -> lxml.html.HtmlElement:
+        """Helper function to get the parsed HTML of the provided web page as an lxml tree
+
+        Querying the tree with XPath runs in lxml's C code, rather than walking the document in Python
+
+        :param url: The basketball reference page from which you want to scrape data
+        :param max_age: How long a cached copy of the page is good for. If `None` it never expires
+        :return: The root element of the page you specified
+        """
+        return lxml.html.fromstring(self._get_page(url, max_age=max_age))
 
     def _scrape_schedule_for_month(self, month: str, year: int) -> List[Dict[str, Any]]:
         """Scrapes the NBA schedule for the given month and year
@@ -43,22 +127,15 @@ class BasketballReferenceWebScraper:
                 ...
             ]
         """
-        html = self._get_parseable_html(f"leagues/NBA_{year}_games-{month}.html")
-        table_body: BeautifulSoup = html.find('tbody')
-        table_rows = table_body.find_all('tr')
+        tree = self._get_html_tree(f"leagues/NBA_{year}_games-{month}.html")
 
         schedule = []
-        for row in table_rows:
-            date_str = row.find('th', attrs={"data-stat": "date_game"}).text
-            game_date = datetime.datetime.strptime(date_str, "%a, %b %d, %Y").date()
-
-            visiting_team = row.find('td', attrs={"data-stat": "visitor_team_name"}).text
-            home_team = row.find('td', attrs={"data-stat": "home_team_name"}).text
-
+        for row in SCHEDULE_ROWS(tree):
+            game_date = datetime.datetime.strptime(SCHEDULE_GAME_DATE(row), "%a, %b %d, %Y").date()
             schedule.append({
                 "game_date": game_date,
-                "home_team": home_team,
-                "visiting_team": visiting_team
+                "home_team": SCHEDULE_HOME_TEAM(row),
+                "visiting_team": SCHEDULE_VISITING_TEAM(row)
             })
 
         return schedule
@@ -84,10 +161,14 @@ class BasketballReferenceWebScraper:
         """
         print(f"Getting NBA schedule for {year}")
         months = ("october", "november", "december", "january", "february", "march", "april")
-        schedule = []
-        for month in months:
-            schedule.extend(self._scrape_schedule_for_month(month, year))
-            time.sleep(10)
+        # Fetching the pages is almost all waiting on the network, so the months are all fetched at once.
+        # That's 7 requests in total, which is well under Basketball Reference's rate limit
+        with ThreadPoolExecutor(max_workers=len(months)) as executor:
+            monthly_schedules = executor.map(lambda month: self._scrape_schedule_for_month(month, year), months)
+
+            schedule = []
+            for monthly_schedule in monthly_schedules:
+                schedule.extend(monthly_schedule)
 
         return schedule
 
@@ -98,7 +179,7 @@ class BasketballReferenceWebScraper:
         :param minutes_played: Minutes played as a string. In the form MM:SS
         :return: Minutes played as a float
         """
-        minutes, seconds = minutes_played.split(":")
+        minutes, _, seconds = minutes_played.partition(":")
         return round(int(minutes) + (int(seconds) / 60), 2)
 
     def scrape_game_log(self, game_date: datetime.date, home_team: str, away_team: str) -> List[Dict[str, Any]]:
@@ -110,51 +191,31 @@ class BasketballReferenceWebScraper:
         :return: The box score of the desired game
         """
         game_date_str = game_date.strftime("%Y%m%d")
-        html = self._get_parseable_html(f"boxscores/{game_date_str}0{home_team}.html")
-        tables: BeautifulSoup = html.find_all("table", {"class": "stats_table"})
+        # The box score of a game that's already been played isn't going to change, so it can be cached for good
+        tree = self._get_html_tree(f"boxscores/{game_date_str}0{home_team}.html", max_age=None)
 
         # Basketball reference has many "stats_table" tables on its box score page,
         # but these are the two that we want
-        home_team_box_score_table = f"box-{home_team}-game-basic"
-        away_team_box_score_table = f"box-{away_team}-game-basic"
-
-        desired_tables = [
-            table for table in tables if table.get("id") in (home_team_box_score_table, away_team_box_score_table)
-        ]
-
-        desired_fields = (
-            "fg",  # field goals made
-            "fga",  # field goal attempts
-            "ft",  # free throws made
-            "fta",  # free throw attempts
-            "fg3",  # three-pointers
-            "pts",  # points
-            "trb",  # total rebounds
-            "ast",  # assists
-            "stl",  # steals
-            "blk",  # blocks
-            "tov",  # turnovers
+        tables = tree.xpath(
+            "//table[@id=$home_table or @id=$away_table]",
+            home_table=f"box-{home_team}-game-basic",
+            away_table=f"box-{away_team}-game-basic"
         )
 
         game_log = []
-        for table in desired_tables:
-            table_header: BeautifulSoup = table.find("thead")
-            header_row = table_header.find_all("tr", limit=2)[1]
-            headers = [th.text.lower() for th in header_row.find_all("th", attrs={"data-stat": desired_fields})]
-
-            table_body: BeautifulSoup = table.find("tbody")
-            rows = table_body.find_all("tr", class_=lambda x: x != "thead")
-            for row in rows:
-                player_name = row.find("th", attrs={"data-stat": "player"}).text
+        for table in tables:
+            headers = [th.text_content().lower() for th in BOX_SCORE_HEADER_CELLS(table)]
 
+            for row in BOX_SCORE_ROWS(table):
                 # This means the player didn't play
-                if row.find("td", attrs={"data-stat": "reason"}):
+                if row.xpath("./td[@data-stat='reason']"):
                     continue
 
-                stats = [td.text for td in row.find_all("td", attrs={"data-stat": desired_fields})]
+                player_name = row.xpath("string(./th[@data-stat='player'])")
+                stats = [td.text_content() for td in BOX_SCORE_DATA_CELLS(row)]
                 stats_dict = dict(zip(headers, stats))
                 # We'll get minutes played separately since we need to convert it into a float
-                minutes_played = row.find("td", attrs={"data-stat": "mp"}).text
+                minutes_played = row.xpath("string(./td[@data-stat='mp'])")
 
                 stats_dict.update({
                     "player_name": sanitize_player_name(player_name),
@@ -1,6 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import time
-from typing import List, Dict, Any, Union, Set
+from operator import itemgetter
+from typing import List, Dict, Any, Optional, Union, Set
 
 import requests
 
@@ -9,6 +10,9 @@ from src.utils.query_tool import QueryTool
 from src.utils.spotrac_scraper_tool import SpotracScraperTool
 from src.yahootils.yahoo_api_tool import YahooFantasyApiTool
 
+# The number of games whose game logs are scraped at the same time
+GAME_LOG_SCRAPERS = 4
+
 
 class DataLoader:
     """Class with methods for loading various data into the db"""
@@ -17,6 +21,7 @@ class DataLoader:
         self.yahoo_api_tool = YahooFantasyApiTool()
         self.bball_reference_scraper = BasketballReferenceWebScraper()
         self.spotrac_scraper = SpotracScraperTool()
+        self._player_id_map = None
 
     def _load_nba_teams(self, nba_teams: List[Dict[str, Any]]) -> None:
         """Load the NBA team data into the nba_teams table
@@ -32,13 +37,8 @@ class DataLoader:
             ]
         """
         print("Loading NBA teams into DB")
-        query = (
-            "INSERT INTO nba_teams VALUES "
-            "(%(team_id)s, %(team_name)s, %(team_code)s) "
-            "ON CONFLICT (nba_team_id) DO UPDATE "
-            "SET team_name = %(team_name)s, team_code = %(team_code)s;"
-        )
-        self.query_tool.insert(query, nba_teams)
+        rows = ((team["team_id"], team["team_name"], team["team_code"]) for team in nba_teams)
+        self.query_tool.upsert("nba_teams", ("nba_team_id", "team_name", "team_code"), ("nba_team_id",), rows)
 
     def _load_players(self, players: List[Dict[str, Any]]) -> None:
         """Load the players into the database
@@ -52,18 +52,23 @@ class DataLoader:
             ]
         """
         print("Loading players into DB")
-        query = (
-            "INSERT INTO players(player_id, player_name, nba_team_id, positions, status) VALUES "
-            "(%(player_id)s, %(player_name)s, %(team_id)s, %(positions)s, %(status)s) "
-            "ON CONFLICT (player_id) DO UPDATE "
-            "SET player_name = %(player_name)s, nba_team_id = %(team_id)s, "
-            "positions = %(positions)s, status = %(status)s;"
+        columns = ("player_id", "player_name", "nba_team_id", "positions", "status")
+        rows = (
+            (player["player_id"], player["player_name"], player["team_id"], player["positions"], player["status"])
+            for player in players
         )
-        self.query_tool.insert(query, players)
+        self.query_tool.upsert("players", columns, ("player_id",), rows)
+        # New players may have been added, so the player ID map needs to be rebuilt
+        self._player_id_map = None
+
+    def load_players_and_nba_teams(self, use_cache: bool = True) -> None:
+        """Get the players and NBA teams data from Yahoo and load it into the DB
 
-    def load_players_and_nba_teams(self) -> None:
-        """Get the players and NBA teams data from Yahoo and load it into the DB"""
-        players, nba_teams = self.yahoo_api_tool.get_players_and_nba_teams()
+        :param use_cache: Whether the players can come from Yahoo's cached responses. Turn it off when
+            the players' statuses have to be up to date
+        """
+        max_age = YahooFantasyApiTool.PLAYER_CACHE_AGE if use_cache else datetime.timedelta(0)
+        players, nba_teams = self.yahoo_api_tool.get_players_and_nba_teams(max_age=max_age)
         self._load_nba_teams(nba_teams)
         self._load_players(players)
 
@@ -78,13 +83,8 @@ class DataLoader:
             ]
         """
         print("Loading teams into DB")
-        query = (
-            "INSERT INTO teams(team_id, team_name, manager) VALUES"
-            "(%(team_id)s, %(team_name)s, %(manager)s) "
-            "ON CONFLICT (team_id) DO UPDATE "
-            "SET team_name = %(team_name)s, manager = %(manager)s;"
-        )
-        self.query_tool.insert(query, teams)
+        rows = ((team["team_id"], team["team_name"], team["manager"]) for team in teams)
+        self.query_tool.upsert("teams", ("team_id", "team_name", "manager"), ("team_id",), rows)
 
     def _load_rosters(self, rosters: List[Dict[str, Any]]) -> None:
         """Load the rosters into the database
@@ -99,11 +99,9 @@ class DataLoader:
             ]
         """
         print("Loading rosters into DB")
-        query = (
-            "INSERT INTO rosters(player_id, team_id) VALUES "
-            "(%(player_id)s, %(team_id)s);"
-        )
-        self.query_tool.insert(query, rosters)
+        query = "INSERT INTO rosters(player_id, team_id) VALUES %s;"
+        template = "(%(player_id)s, %(team_id)s)"
+        self.query_tool.insert_values(query, rosters, template)
 
     def load_teams_and_rosters(self) -> None:
         """Get the fantasy team and roster data from Yahoo and load it into the DB"""
@@ -111,6 +109,25 @@ class DataLoader:
         self._load_teams(teams)
         self._load_rosters(rosters)
 
+    def load_players_teams_and_rosters(self) -> None:
+        """Get the players, NBA teams, fantasy teams and rosters from Yahoo and load them into the DB
+
+        The rosters can't be loaded until the players are, but the request for them doesn't
+        depend on anything, so it's made while the player pool is being fetched. The player pool leaves
+        out the players whose status is NA, so the rostered players that come back with the rosters
+        are loaded too, to make sure every player on a roster is in the DB
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            teams_and_rosters = executor.submit(self.yahoo_api_tool.get_teams_rosters_and_players)
+            players, nba_teams = self.yahoo_api_tool.get_players_and_nba_teams()
+            teams, rosters, rostered_players, rostered_nba_teams = teams_and_rosters.result()
+
+        # Most of the rostered players are in the pool too, but the upserts only keep one row per key
+        self._load_nba_teams(nba_teams + rostered_nba_teams)
+        self._load_players(players + rostered_players)
+        self._load_teams(teams)
+        self._load_rosters(rosters)
+
     def load_matchups(self) -> None:
         """Load the match-ups into the database
 
@@ -120,32 +137,9 @@ class DataLoader:
         print("Loading matchups into DB")
         team_id = self.query_tool.select("select team_id from teams where manager = 'Danny'")[0]["team_id"]
         match_ups = self.yahoo_api_tool.get_match_ups(team_id)
-        query = (
-            "INSERT INTO match_ups(team_id, week_no, week_start, week_end, is_playoffs) VALUES "
-            "(%(team_id)s, %(week_no)s, %(week_start)s, %(week_end)s, %(is_playoffs)s);"
-        )
-        self.query_tool.insert(query, match_ups)
-
-    def _get_team_id_map(self) -> Dict[str, int]:
-        """Helper function to create a map of NBA team names to IDs
-
-        :return: A map of team names to IDs. Looks like:
-            {
-                "Chicago Bulls": 1,
-                "Portland Trailblazers": 2,
-                ...
-            }
-        """
-        query = "SELECT nba_team_id, team_name FROM nba_teams;"
-        nba_teams = self.query_tool.select(query)
-
-        team_id_map = {}
-        for team in nba_teams:
-            team_name = team["team_name"]
-            team_id = team["nba_team_id"]
-            team_id_map[team_name] = team_id
-
-        return team_id_map
+        query = "INSERT INTO match_ups(team_id, week_no, week_start, week_end, is_playoffs) VALUES %s;"
+        template = "(%(team_id)s, %(week_no)s, %(week_start)s, %(week_end)s, %(is_playoffs)s)"
+        self.query_tool.insert_values(query, match_ups, template)
 
     def _get_season_year(self) -> int:
         """Get the year that the current NBA season *ends in*.
@@ -158,10 +152,9 @@ class DataLoader:
         year = self.query_tool.select(query)[0]["season_end"].year
         return year
 
-    def _load_schedule(self, schedule: List[Dict[str, Any]], team_id_map: Dict[str, int]) -> None:
+    def _load_schedule(self, schedule: List[Dict[str, Any]]) -> None:
         """Load the NBA schedule into the database
 
-        :param team_id_map: A map of team names to team IDs
         :param schedule: The NBA schedule scraped. Looks like:
             [
                 {
@@ -172,25 +165,45 @@ class DataLoader:
                 ...
             ]
         """
-        for row in schedule:
-            row["home_team_id"] = team_id_map[row["home_team"]]
-            row["away_team_id"] = team_id_map[row["visiting_team"]]
-
+        columns = ("game_date", "home_team", "away_team")
+        rows = ((row["game_date"], row["home_team"], row["visiting_team"]) for row in schedule)
+        # The team names are swapped for their IDs by joining on nba_teams, so there's no need to look them up here.
+        # Almost none of the games will already be loaded, so rather than have every row go through ON CONFLICT,
+        # the ones that aren't in the schedule yet are picked out in a single anti-join
         query = (
-            "INSERT INTO nba_schedule(game_date, home_team_id, away_team_id) VALUES "
-            "(%(game_date)s, %(home_team_id)s, %(away_team_id)s) "
-            "ON CONFLICT DO NOTHING;"
+            "INSERT INTO nba_schedule(game_date, home_team_id, away_team_id) "
+            "SELECT DISTINCT game_date, home_teams.nba_team_id, away_teams.nba_team_id FROM stg_nba_schedule "
+            "JOIN nba_teams home_teams ON (home_teams.team_name = stg_nba_schedule.home_team) "
+            "JOIN nba_teams away_teams ON (away_teams.team_name = stg_nba_schedule.away_team) "
+            "WHERE NOT EXISTS (SELECT 1 FROM nba_schedule "
+            "WHERE nba_schedule.game_date = stg_nba_schedule.game_date "
+            "AND nba_schedule.home_team_id = home_teams.nba_team_id "
+            "AND nba_schedule.away_team_id = away_teams.nba_team_id);"
+        )
+        # The joins above would quietly drop the games of any team that isn't in nba_teams under the same name,
+        # so those teams are looked for first and the load fails instead of leaving holes in the schedule
+        missing_query = (
+            "SELECT DISTINCT staged_teams.team_name FROM stg_nba_schedule, "
+            "UNNEST(ARRAY[stg_nba_schedule.home_team, stg_nba_schedule.away_team]) AS staged_teams(team_name) "
+            "WHERE NOT EXISTS (SELECT 1 FROM nba_teams WHERE nba_teams.team_name = staged_teams.team_name) "
+            "ORDER BY staged_teams.team_name;"
         )
-        self.query_tool.insert(query, schedule)
+        definition = "game_date DATE, home_team TEXT, away_team TEXT"
+        with self.query_tool.staging_table("stg_nba_schedule", definition, columns, rows):
+            missing_teams = self.query_tool.select(missing_query)
+            if missing_teams:
+                team_names = ", ".join(team["team_name"] for team in missing_teams)
+                raise KeyError(f"These teams in the schedule are missing from the DB: {team_names}")
+
+            self.query_tool.insert(query)
 
     def load_schedule(self) -> None:
         """Get the NBA season schedule from Basketball Reference and load it into the DB"""
         print("Loading schedule into DB")
-        team_id_map = self._get_team_id_map()
         year = self._get_season_year()
         schedule = self.bball_reference_scraper.scrape_schedule(year)
 
-        self._load_schedule(schedule, team_id_map)
+        self._load_schedule(schedule)
 
     def _get_player_id_map(self) -> Dict[str, int]:
         """Create a map for player name to ID
@@ -198,6 +211,8 @@ class DataLoader:
         Also includes any player "aliases" mapped to the correct ID.
         For example, "Mo Bamba" vs "Mohamad Bamba"
 
+        The map is cached on the instance until the players are reloaded
+
         :return: A map for player names to IDs. Looks like:
             {
                 "Michael Jordan": 1,
@@ -206,49 +221,88 @@ class DataLoader:
                 ...
             }
         """
-        player_id_map = {}
+        if self._player_id_map is not None:
+            return self._player_id_map
 
+        # The map is built by postgres and comes back as a single JSON object,
+        # instead of as a row for every player and alias that has to be put in the map here
         query = (
-            "WITH aliases AS ("
-            "SELECT player_id, player_name, UNNEST(player_aliases) as alias "
-            "FROM players) "
-            "SELECT player_id, players.player_name, alias "
-            "FROM players "
-            "LEFT JOIN aliases USING (player_id)"
+            "SELECT jsonb_object_agg(name, player_id) AS player_id_map "
+            "FROM (SELECT player_id, UNNEST(ARRAY[player_name] || COALESCE(player_aliases, '{}')) AS name "
+            "FROM players) AS names "
+            "WHERE name IS NOT NULL;"
+        )
+        # There's no map at all if the players table is empty
+        self._player_id_map = self.query_tool.select(query)[0]["player_id_map"] or {}
+
+        return self._player_id_map
+
+    def _load_salaries(self, salaries: List[Dict[str, Any]]) -> None:
+        """Load the player salaries into the database
+
+        :param salaries: The salaries scraped from Spotrac. Looks like:
+            [
+                {
+                    "player_name": "Michael Jordan",
+                    "salary": 1000000000
+                },
+                ...
+            ]
+        """
+        # The names are matched up with the players by postgres, which is also what finds the ones that
+        # aren't in the DB. A player can be listed more than once, i.e. under a nickname as well as their name,
+        # so only their first salary is used. Otherwise the update would have more than one salary to choose from
+        player_match = (
+            "(players.player_name = stg_salaries.player_name OR stg_salaries.player_name = ANY(players.player_aliases))"
+        )
+        update_query = (
+            "UPDATE players SET salary = matched_salaries.salary "
+            "FROM (SELECT DISTINCT ON (players.player_id) players.player_id, stg_salaries.salary "
+            f"FROM stg_salaries JOIN players ON {player_match} "
+            "ORDER BY players.player_id, stg_salaries.position) AS matched_salaries "
+            "WHERE players.player_id = matched_salaries.player_id;"
+        )
+        missing_query = (
+            "SELECT player_name FROM stg_salaries "
+            f"WHERE NOT EXISTS (SELECT 1 FROM players WHERE {player_match}) "
+            "ORDER BY position;"
         )
-        results = self.query_tool.select(query)
-        for row in results:
-            player_name = row["player_name"]
-            player_id = row["player_id"]
-            player_id_map[player_name] = player_id
 
-            alias = row["alias"]
-            if alias:
-                player_id_map[alias] = player_id
+        columns = ("position", "player_name", "salary")
+        rows = ((position, row["player_name"], row["salary"]) for position, row in enumerate(salaries))
+        definition = "position INTEGER, player_name TEXT, salary INTEGER"
+        with self.query_tool.staging_table("stg_salaries", definition, columns, rows):
+            self.query_tool.insert(update_query)
+            missing_players = self.query_tool.select(missing_query)
 
-        return player_id_map
+        print("These players are missing from the DB:")
+        for player in missing_players:
+            print(player["player_name"])
 
     def load_salaries(self) -> None:
         """Get the player salaries from Spotrac and load them into the DB"""
         print("Loading salaries into DB")
-        player_id_map = self._get_player_id_map()
         year = self._get_season_year()
-
         salaries = self.spotrac_scraper.scrape_salaries(year)
-        missing_players = []
-        for row in salaries:
-            row["player_id"] = player_id_map.get(row["player_name"])
-            if row["player_id"] is None:
-                missing_players.append(row)
 
-        query = (
-            "UPDATE players SET salary = %(salary)s WHERE player_id = %(player_id)s;"
-        )
-        self.query_tool.insert(query, salaries)
+        self._load_salaries(salaries)
 
-        print("These players are missing from the DB:")
-        for player in missing_players:
-            print(player["player_name"])
+    def load_schedule_and_salaries(self) -> None:
+        """Get the NBA schedule from Basketball Reference and the player salaries from Spotrac
+        and load them into the DB
+
+        The two scrapes only depend on the season year and are almost entirely spent waiting
+        on the network, so they're run at the same time
+        """
+        print("Loading schedule and salaries into DB")
+        year = self._get_season_year()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            schedule = executor.submit(self.bball_reference_scraper.scrape_schedule, year)
+            salaries = executor.submit(self.spotrac_scraper.scrape_salaries, year)
+
+            self._load_salaries(salaries.result())
+            self._load_schedule(schedule.result())
 
     def _get_latest_loaded_game_log_date(self) -> datetime.date:
         """Get the latest date in the game_log table for which there is data"""
@@ -256,11 +310,17 @@ class DataLoader:
         latest_date = self.query_tool.select(query)[0]["latest_date"]
         return latest_date + datetime.timedelta(days=1)
 
-    def _get_schedule(self, start_date: Union[str, datetime.date], team: str = None) -> List[Dict[str, str]]:
+    def _get_schedule(
+            self,
+            start_date: Union[str, datetime.date],
+            team: str = None,
+            skip_loaded: bool = True
+    ) -> List[Dict[str, str]]:
         """Get the NBA schedule from the provided start date to today
 
         :param start_date: The lower bound for the schedule select query
         :param team: Optional parameter to specify which team's schedule you want
+        :param skip_loaded: Whether to leave out the games whose game logs have already been loaded
         :return: The NBA schedule between start_date and today. Looks like:
             [
                 {
@@ -275,6 +335,19 @@ class DataLoader:
         if team:
             team_clause = "AND (home_teams.team_code = %(team)s OR away_teams.team_code = %(team)s)"
 
+        # A game counts as loaded once there are game logs on its date for players on both of its teams.
+        # Checking both teams keeps a player who was traded from making the game look loaded
+        loaded_clause = ""
+        if skip_loaded:
+            loaded_clause = (
+                "AND NOT (EXISTS (SELECT 1 FROM game_log JOIN players USING (player_id) "
+                "WHERE game_log.game_date = nba_schedule.game_date "
+                "AND players.nba_team_id = nba_schedule.home_team_id) "
+                "AND EXISTS (SELECT 1 FROM game_log JOIN players USING (player_id) "
+                "WHERE game_log.game_date = nba_schedule.game_date "
+                "AND players.nba_team_id = nba_schedule.away_team_id))"
+            )
+
         # Note we had to change some of the team codes because Basketball Reference's don't match Yahoo's
         query = (
             "WITH modified_nba_teams as (SELECT nba_team_id, "
@@ -286,7 +359,7 @@ class DataLoader:
             "FROM nba_schedule "
             "JOIN modified_nba_teams home_teams on (home_teams.nba_team_id = nba_schedule.home_team_id) "
             "JOIN modified_nba_teams away_teams on (away_teams.nba_team_id = nba_schedule.away_team_id) "
-            f"WHERE game_date between %(start_date)s AND %(end_date)s {team_clause}"
+            f"WHERE game_date between %(start_date)s AND %(end_date)s {team_clause} {loaded_clause}"
         )
         params = {
             "start_date": start_date,
@@ -315,18 +388,28 @@ class DataLoader:
             else:
                 upload.append(row)
 
+        # The same statement is run for every batch, so it's prepared once and then just executed
         query = (
             "INSERT INTO game_log(player_id, game_date, minutes_played, field_goals, field_goal_attempts, "
             "free_throws, free_throw_attempts, three_pointers, points, rebounds, assists, steals, blocks, "
-            "turnovers) VALUES (%(player_id)s, %(game_date)s, %(mp)s, %(fg)s, %(fga)s, %(ft)s, %(fta)s, %(3p)s, "
-            "%(pts)s, %(trb)s, %(ast)s, %(stl)s, %(blk)s, %(tov)s) "
+            "turnovers) SELECT * FROM UNNEST($1::INTEGER[], $2::DATE[], $3::REAL[], $4::INTEGER[], $5::INTEGER[], "
+            "$6::INTEGER[], $7::INTEGER[], $8::INTEGER[], $9::INTEGER[], $10::INTEGER[], $11::INTEGER[], "
+            "$12::INTEGER[], $13::INTEGER[], $14::INTEGER[]) "
             "ON CONFLICT(player_id, game_date) DO UPDATE SET "
-            "minutes_played = %(mp)s, field_goals = %(fg)s, field_goal_attempts = %(fga)s, "
-            "free_throws = %(ft)s, free_throw_attempts = %(fta)s, three_pointers = %(3p)s, "
-            "points = %(pts)s, rebounds = %(trb)s, assists = %(ast)s, steals = %(stl)s, blocks = %(blk)s, "
-            "turnovers = %(tov)s"
+            "minutes_played = EXCLUDED.minutes_played, field_goals = EXCLUDED.field_goals, "
+            "field_goal_attempts = EXCLUDED.field_goal_attempts, free_throws = EXCLUDED.free_throws, "
+            "free_throw_attempts = EXCLUDED.free_throw_attempts, three_pointers = EXCLUDED.three_pointers, "
+            "points = EXCLUDED.points, rebounds = EXCLUDED.rebounds, assists = EXCLUDED.assists, "
+            "steals = EXCLUDED.steals, blocks = EXCLUDED.blocks, turnovers = EXCLUDED.turnovers"
         )
-        self.query_tool.insert(query, upload)
+        fields = (
+            "player_id", "game_date", "mp", "fg", "fga", "ft", "fta", "3p", "pts", "trb", "ast", "stl", "blk", "tov"
+        )
+        if upload:
+            # The rows are picked apart by itemgetter and transposed into columns by zip,
+            # so the values are moved around in C rather than in a Python loop per column
+            columns = list(zip(*map(itemgetter(*fields), upload)))
+            self.query_tool.insert_prepared("game_log_upsert", query, columns)
 
         return missing_players
 
@@ -336,43 +419,64 @@ class DataLoader:
         :param schedule: The NBA schedule
         :return: The game logs for each game in the provided schedule
         """
-        game_logs = []
-        games_scraped = 0
-        missing_players = set()
-        for row in schedule:
+        def scrape_game_log(row: Dict[str, str]) -> Optional[List[Dict[str, Any]]]:
             print(f"Getting game log for {row}")
             try:
-                game_log = self.bball_reference_scraper.scrape_game_log(**row)
-                time.sleep(5)
-            except requests.exceptions.ConnectionError:
+                return self.bball_reference_scraper.scrape_game_log(**row)
+            except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
                 print(f"Game for {row} not found")
-                continue
+                return None
 
-            game_logs.extend(game_log)
-            games_scraped += 1
-
-            if games_scraped % 20 == 0:
-                print("Loading batch of games")
-                missing_players.union(self._load_game_batch(game_logs, player_id_map))
-                game_logs = []
+        game_logs = []
+        games_scraped = 0
+        missing_players = set()
+        # Scraping is mostly waiting on the network, so a few games are scraped at once. The scraper
+        # keeps the requests under Basketball Reference's rate limit, so there's no need to sleep between them
+        with ThreadPoolExecutor(max_workers=GAME_LOG_SCRAPERS) as executor:
+            for game_log in executor.map(scrape_game_log, schedule):
+                if game_log is None:
+                    continue
+
+                game_logs.extend(game_log)
+                games_scraped += 1
+
+                if games_scraped % 20 == 0:
+                    print("Loading batch of games")
+                    missing_players.update(self._load_game_batch(game_logs, player_id_map))
+                    game_logs = []
+
+        # Load whatever's left over from the last partial batch
+        if game_logs:
+            print("Loading last batch of games")
+            missing_players.update(self._load_game_batch(game_logs, player_id_map))
 
         return missing_players
 
-    def load_game_logs(self, start_date: str = None, team: str = None) -> None:
+    def _refresh_league_averages(self) -> None:
+        """Refresh the materialized view of league averages so that it includes the newly loaded game logs"""
+        query = "REFRESH MATERIALIZED VIEW league_percentage_averages;"
+        self.query_tool.insert(query)
+
+    def load_game_logs(self, start_date: str = None, team: str = None, reload: bool = False) -> None:
         """Get the game log data from Basketball Reference and load it into the DB
 
         :param start_date: Optional start date for loading the game logs. If not supplied,
             defaults to the latest date in the `game_log` table
         :param team: Optional team whose game logs you want
+        :param reload: Whether to load the games whose game logs are already in the DB again.
+            By default those games are skipped
         """
         if start_date is None:
             start_date = self._get_latest_loaded_game_log_date()
 
         print(f"Loading game logs from {start_date} to today into DB")
-        schedule = self._get_schedule(start_date, team)
+        schedule = self._get_schedule(start_date, team, skip_loaded=not reload)
         player_id_map = self._get_player_id_map()
         missing_players = self._get_game_logs(schedule, player_id_map)
 
+        print("Refreshing league averages")
+        self._refresh_league_averages()
+
         print("These players are missing from the DB:")
         for player in missing_players:
             print(player)
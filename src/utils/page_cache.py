@@ -0,0 +1,52 @@
+"""On-disk cache for scraped web pages, so re-running a scrape doesn't have to hit the network again"""
+from typing import Callable, Optional
+
+import datetime
+import gzip
+import hashlib
+import os
+import time
+
+CACHE_DIR = os.path.join(os.getenv("BBALL_HOME", "."), ".cache", "pages")
+
+
+def _get_cache_path(url: str) -> str:
+    """Get the path of the file that the given page is cached in
+
+    :param url: The URL of the page
+    :return: The path to the cache file for the page
+    """
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{digest}.html.gz")
+
+
+def get_cached_page(
+        url: str,
+        download: Callable[[], bytes],
+        max_age: Optional[datetime.timedelta] = datetime.timedelta(days=1)
+) -> bytes:
+    """Get the content of a web page, only downloading it if there isn't a fresh copy in the cache
+
+    :param url: The URL of the page. This is what the page is cached by
+    :param download: Function that downloads the page. Only called on a cache miss
+    :param max_age: How long a cached page is good for. If `None` the cached page never expires,
+        which is what you want for pages that won't change anymore
+    :return: The content of the page
+    """
+    path = _get_cache_path(url)
+    if os.path.exists(path):
+        age = time.time() - os.path.getmtime(path)
+        if max_age is None or age < max_age.total_seconds():
+            with gzip.open(path, "rb") as fp:
+                return fp.read()
+
+    content = download()
+
+    # Write to a temporary file first so an interrupted run can't leave a truncated page in the cache
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, "wb") as fp:
+        fp.write(content)
+    os.replace(temp_path, path)
+
+    return content
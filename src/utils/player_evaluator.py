@@ -1,4 +1,6 @@
-from typing import List, Dict, Any, Union, Optional
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
 
 from src.utils.query_tool import QueryTool
 
@@ -11,16 +13,16 @@ class PlayerEvaluator:
     then summing those values.
     """
 
-    NON_COUNTING_STATS = (
+    # Only ever used for membership checks
+    NON_COUNTING_STATS = frozenset((
         "player_name",
         "positions",
         "team_code",
         "status",
-        "fantasy_team",
         "salary",
         "manager",
         "minutes_per_game"
-    )
+    ))
 
     WEIGHTS = {
         'field_goal_percentage': 1.0,
@@ -43,108 +45,71 @@ class PlayerEvaluator:
         self.query_tool = QueryTool()
         self.weights = weights or self.WEIGHTS
 
-    def _get_players_totals(
+    def _get_players_stats(
             self,
+            aggregate: str,
             start_date: Optional[str] = None,
             end_date: Optional[str] = None,
-    ) -> List[Dict[str, Any]]:
+    ) -> Dict[str, List[Any]]:
         """Load all the players and their statistics from the database
 
+        :param aggregate: The aggregate function applied to each player's game logs, i.e. `SUM` or `AVG`
         :param start_date: The lower bound for game_date for the query
         :param end_date: The upper bound for game_date for the query
-        :return: A list of all the players and their stat totals
+        :return: All the players and their aggregated stats, as a dict mapping each column to its list of values
         """
         where_clause = ""
         if start_date and end_date:
-            where_clause = f" AND game_log.game_date BETWEEN '{start_date}'::DATE AND '{end_date}'::DATE "
+            where_clause = " AND game_log.game_date BETWEEN %(start_date)s::DATE AND %(end_date)s::DATE "
         query = (
-            "SELECT player_name, team_code, ARRAY_TO_STRING(positions, ',') as positions, status, "
+            "SELECT player_name, team_code, positions, status, "
             "AVG(minutes_played) as minutes_per_game, COALESCE(salary, 0) as salary, "
-            "SUM(field_goals) AS field_goals, SUM(field_goal_attempts) AS field_goal_attempts, "
-            "SUM(free_throws) as free_throws, SUM(free_throw_attempts) as free_throw_attempts, "
-            "SUM(three_pointers) AS three_pointers, SUM(points) AS points, "
-            "SUM(rebounds) as rebounds, SUM(assists) AS assists, SUM(steals) as steals, "
-            "SUM(blocks) as blocks, SUM(turnovers) as turnovers, fantasy_teams.team_name AS fantasy_team, "
-            "fantasy_teams.manager "
+            f"{aggregate}(field_goals) AS field_goals, {aggregate}(field_goal_attempts) AS field_goal_attempts, "
+            f"{aggregate}(free_throws) as free_throws, {aggregate}(free_throw_attempts) as free_throw_attempts, "
+            f"{aggregate}(three_pointers) AS three_pointers, {aggregate}(points) AS points, "
+            f"{aggregate}(rebounds) as rebounds, {aggregate}(assists) AS assists, {aggregate}(steals) as steals, "
+            f"{aggregate}(blocks) as blocks, {aggregate}(turnovers) as turnovers, fantasy_teams.manager "
             "FROM players "
             "JOIN game_log USING (player_id) "
             "JOIN nba_teams USING (nba_team_id) "
             "LEFT JOIN rosters USING (player_id) "
             "LEFT JOIN teams AS fantasy_teams USING (team_id)"
             f"WHERE salary > 0 {where_clause}"
-            "GROUP BY player_name, team_code, positions, status, salary, fantasy_team, manager;"
+            "GROUP BY player_name, team_code, positions, status, salary, manager"
         )
-        return self.query_tool.select(query)
+        params = {"start_date": start_date, "end_date": end_date}
+        return self.query_tool.select_columns(self._add_percentage_impacts(query), params)
 
-    def _get_players_averages(
+    def _get_players_totals(
             self,
             start_date: Optional[str] = None,
             end_date: Optional[str] = None,
-    ) -> List[Dict[str, Any]]:
-        """Load all the players and their statistics from the database
+    ) -> Dict[str, List[Any]]:
+        """Load all the players and their stat totals from the database
 
         :param start_date: The lower bound for game_date for the query
         :param end_date: The upper bound for game_date for the query
-        :return: A list of all the players and their stat totals
+        :return: All the players and their stat totals, as a dict mapping each column to its list of values
         """
-        where_clause = ""
-        if start_date and end_date:
-            where_clause = f" AND game_log.game_date BETWEEN '{start_date}'::DATE AND '{end_date}'::DATE "
-        query = (
-            "SELECT player_name, team_code, ARRAY_TO_STRING(positions, ',') as positions, status, "
-            "AVG(minutes_played) as minutes_per_game, COALESCE(salary, 0) as salary, "
-            "AVG(field_goals) AS field_goals, AVG(field_goal_attempts) AS field_goal_attempts, "
-            "AVG(free_throws) as free_throws, AVG(free_throw_attempts) as free_throw_attempts, "
-            "AVG(three_pointers) AS three_pointers, AVG(points) AS points, "
-            "AVG(rebounds) as rebounds, AVG(assists) AS assists, AVG(steals) as steals, "
-            "AVG(blocks) as blocks, AVG(turnovers) as turnovers, fantasy_teams.team_name AS fantasy_team, "
-            "fantasy_teams.manager "
-            "FROM players "
-            "JOIN game_log USING (player_id) "
-            "JOIN nba_teams USING (nba_team_id) "
-            "LEFT JOIN rosters USING (player_id) "
-            "LEFT JOIN teams AS fantasy_teams USING (team_id)"
-            f"WHERE salary > 0 {where_clause}"
-            "GROUP BY player_name, team_code, positions, status, salary, fantasy_team, manager;"
-        )
-        return self.query_tool.select(query)
-
-    def _get_average_percentage_stats(self) -> Dict[str, Union[int, float]]:
-        """Run a query to get the team-level average percentage statistics
+        return self._get_players_stats("SUM", start_date=start_date, end_date=end_date)
 
-        The sums of the fields are divided by 30 because there are 30 teams in the
-        NBA. So to get our average percentage statistic for the whole league we're looking
-        at the average makes/attempts per team
+    def _get_players_averages(
+            self,
+            start_date: Optional[str] = None,
+            end_date: Optional[str] = None,
+    ) -> Dict[str, List[Any]]:
+        """Load all the players and their stat averages from the database
 
-        :return: A dict that contains the averages calculated in the query
+        :param start_date: The lower bound for game_date for the query
+        :param end_date: The upper bound for game_date for the query
+        :return: All the players and their stat averages, as a dict mapping each column to its list of values
         """
-        query = (
-            "WITH averages AS (SELECT SUM(field_goals) / 30 AS avg_field_goals, "
-            "SUM(field_goal_attempts) / 30 AS avg_field_goal_attempts, "
-            "SUM(free_throws) / 30 AS avg_free_throws, "
-            "SUM(free_throw_attempts) / 30 AS avg_free_throw_attempts "
-            "FROM player_stat_totals) "
-            "SELECT avg_field_goals, avg_field_goal_attempts, "
-            "avg_field_goals::real / avg_field_goal_attempts::real as avg_field_goal_percentage, "
-            "avg_free_throws, avg_free_throw_attempts, "
-            "avg_free_throws::real / avg_free_throw_attempts::real as avg_free_throw_percentage "
-            "FROM averages;"
-        )
-
-        return self.query_tool.select(query)[0]
+        return self._get_players_stats("AVG", start_date=start_date, end_date=end_date)
 
     @staticmethod
-    def _percent_change(original: Union[int, float], new: Union[int, float]) -> float:
-        """Function to get the percent change between two values
-
-        :param original: The original value
-        :param new: The new value
-        :return: The percent change between the new value and the original value
-        """
-        return (float(new) - original) / abs(original)
-
-    def _calculate_percentage_impacts(self, players: List[Dict[str, Any]]) -> None:
-        """Calculates the "impacts" each player has on percentage statistics.
+    def _add_percentage_impacts(player_stats_query: str) -> str:
+        """Wrap a query for the players' stats so that it also calculates the "impacts" each player has on
+        percentage statistics.
 
         The idea here is that first we get our per-team averages for, for example,
         field goals, field goal attempts, and field goal percentage. Then for each player
@@ -157,122 +122,73 @@ class PlayerEvaluator:
         will have their field goal percentage count more towards the player's relative value
         than a player who shoots 60% on 5 attempts per game.
 
-        :param players: The list of players
-        """
-        averages = self._get_average_percentage_stats()
-        for player in players:
-            field_goals = player['field_goals']
-            field_goal_attempts = player['field_goal_attempts']
-            adjusted_fg_percentage = (
-                    (field_goals + averages["avg_field_goals"]) /
-                    (field_goal_attempts + averages["avg_field_goal_attempts"])
-            )
-            fg_impact = self._percent_change(averages["avg_field_goal_percentage"], adjusted_fg_percentage)
-
-            player["field_goal_percentage"] = fg_impact
+        The per-team averages come from the `league_percentage_averages` materialized view, which is
+        joined onto every player row, so the impacts are calculated in the same round trip as the stats.
+        The makes and attempts themselves aren't returned, because the impacts are used from then on.
 
-            free_throws = player['free_throws']
-            free_throw_attempts = player['free_throw_attempts']
-            adjusted_ft_percentage = (
-                    (free_throws + averages["avg_free_throws"]) /
-                    (free_throw_attempts + averages["avg_free_throw_attempts"])
-            )
-            ft_impact = self._percent_change(averages["avg_free_throw_percentage"], adjusted_ft_percentage)
-
-            player["free_throw_percentage"] = ft_impact
-
-            # Don't need these anymore because our percentage impact values will be used from now on
-            [player.pop(key) for key in ("field_goals", "field_goal_attempts", "free_throws", "free_throw_attempts")]
-
-    def _get_means_and_std_devs(self, players: List[Dict[str, Any]]) -> Dict[str, Dict]:
-        """Function to get the means and standard deviations of each counting statistic
-        :param players: The list of players
-        :param stats: The list of stats for which you want to calculate the mean/std dev.
-            If `None` provided will calculate them for all the fields in a player dict
-            (besides those in NON_COUNTING_STATS).
-        :return: A dict with each statistic and its mean and standard deviation. For example:
-            {
-                'points': {
-                    'mean': 1.0,
-                    'std_dev': 2500.0
-                },
-                'rebounds': {
-                    'mean': 0.0,
-                    'std_dev': 1000.0
-                }
-            }
+        :param player_stats_query: The query for the players' stats. Must return field_goals, field_goal_attempts,
+            free_throws, and free_throw_attempts columns
+        :return: The query for the players' stats with their percentage impacts
         """
-        stats = players[0].keys()
-
-        means_and_std_devs = {field: {'mean': 0.0, 'std_dev': 0.0}
-                              for field in stats if field not in self.NON_COUNTING_STATS}
-        for field in means_and_std_devs.keys():
-            # so for example this would be a list of every player's point total
-            whole_leagues_stat = [p[field] for p in players]
-            # we then calculate the league mean points scored
-            mean = sum(whole_leagues_stat) / len(whole_leagues_stat)
-            # and the variance
-            variance = sum([((x - mean) ** 2) for x in whole_leagues_stat]) / len(whole_leagues_stat)
-            std_dev = float(variance) ** 0.5
+        return (
+            f"WITH player_stats AS ({player_stats_query}) "
+            "SELECT player_name, team_code, positions, status, minutes_per_game, salary, "
+            "((field_goals + avg_field_goals)::double precision / (field_goal_attempts + avg_field_goal_attempts) "
+            "- avg_field_goal_percentage) / ABS(avg_field_goal_percentage) AS field_goal_percentage, "
+            "((free_throws + avg_free_throws)::double precision / (free_throw_attempts + avg_free_throw_attempts) "
+            "- avg_free_throw_percentage) / ABS(avg_free_throw_percentage) AS free_throw_percentage, "
+            "three_pointers, points, rebounds, assists, steals, blocks, turnovers, manager "
+            "FROM player_stats "
+            "CROSS JOIN league_percentage_averages"
+        )
 
-            means_and_std_devs[field]['mean'] = mean
-            means_and_std_devs[field]['std_dev'] = std_dev
+    def _get_stats_matrix(self, columns: Dict[str, List[Any]]) -> Tuple[List[str], np.ndarray]:
+        """Pack the counting statistics of every player into a single array
 
-        return means_and_std_devs
+        :param columns: The players, as a dict mapping each column to its list of values
+        :return: The names of the counting statistics (everything besides those in NON_COUNTING_STATS),
+            and an array of shape (number of players, number of stats) where each column holds a single
+            statistic for every player, in the same order as the names
+        """
+        stats = [stat for stat in columns if stat not in self.NON_COUNTING_STATS]
+        # Each statistic is already a column, so they're stacked as is without touching the players one at a time
+        stats_matrix = np.column_stack([np.asarray(columns[stat], dtype=np.float64) for stat in stats])
+        return stats, stats_matrix
 
-    @staticmethod
-    def _normalize(value: Union[int, float], mean: float, std_dev: float) -> float:
-        """Function to return the normalized value of a statistic.
+    def _normalize_stats(self, stats_matrix: np.ndarray) -> np.ndarray:
+        """Function to normalized all the counting statistics associated with each player.
 
         Here we are defining "normalized" as a z-score, calculated as:
         (x - mean) / std_dev
 
-        :param value: The value being normalized
-        :param mean: The mean of the corresponding statistic amongst all players
-        :param std_dev: The standard_deviation of the corresponding statistic amongst all players
-        :return: The normalized value
-        """
-        return float((value - mean)) / float(std_dev)
-
-    def _normalize_stats(self, players: List[Dict[str, Any]]) -> None:
-        """Function to normalized all the counting statistics associated with each player.
-
         Salary is not normalized because we need the original salary values in order to meet our salary cap
         constraint.
-        :param players: The list of players whose stats are being normalized
-
-        Does not return anything but modifies the player list
+        :param stats_matrix: The counting statistics of every player, one column per statistic.
+            It is normalized in place, so the raw values are gone afterwards
+        :return: The z-scores of every player's counting statistics, which is the same array as the stats matrix
         """
-        means_and_std_devs = self._get_means_and_std_devs(players)
-        for player in players:
-            for stat, value in player.items():
-                if stat in self.NON_COUNTING_STATS:
-                    continue
-
-                player[stat] = self._normalize(value, **means_and_std_devs[stat])
-
-    def _get_relative_value(self, players: List[Dict[str, Any]]) -> None:
+        stats_matrix -= stats_matrix.mean(axis=0)
+        # The columns are already centered, so the standard deviations come straight from their sums of squares.
+        # That saves `std` from recomputing the means and allocating a squared copy of the whole matrix
+        std_devs = np.sqrt(np.einsum("ij,ij->j", stats_matrix, stats_matrix) / len(stats_matrix))
+        # A stat that's the same for every player, i.e. all zeros early in the season, has no spread to divide by.
+        # Its centered values are all zero already, so they're left as z-scores of zero instead of becoming NaNs
+        stats_matrix /= np.where(std_devs == 0, 1, std_devs)
+        return stats_matrix
+
+    def _get_relative_value(self, stats: List[str], normalized_stats: np.ndarray) -> np.ndarray:
         """Function to calculate the relative value of each player.
 
         Relative value is calculated as the sum of the z-scores of the stats multiplied by their respective weights,
         where the weights are defined in a global variable at the top of the file.
 
-        :param players: The list of players
-
-        Does not return anything, but modifies the players list, adding a "relative_value" attribute
-        to each player
+        :param stats: The names of the statistics in each column of the normalized stats
+        :param normalized_stats: The z-scores of every player's counting statistics
+        :return: The relative value of each player
         """
-        stats_to_skip = self.NON_COUNTING_STATS
-        for player in players:
-            total = 0.0
-            for stat, value in player.items():
-                weight = self.weights.get(stat, 0.0)
-                if stat in stats_to_skip:
-                    continue
-                else:
-                    total += value * weight
-
-            player['relative_value'] = total
+        weights = np.array([self.weights.get(stat, 0.0) for stat in stats], dtype=np.float64)
+        # A single matrix-vector product, rather than materializing the weighted z-scores and then summing them
+        return normalized_stats @ weights
 
     def evaluate_players(
             self,
@@ -288,18 +204,26 @@ class PlayerEvaluator:
             players will be evaluate based on their stat averages
         :return: The list of players with all their counting stats normalized and their relative value calculated
         """
+        # Everything is worked on column by column, and the player dicts are only built once at the very end
         if use_totals:
-            players = self._get_players_totals(
+            columns = self._get_players_totals(
                 start_date=start_date,
                 end_date=end_date
             )
         else:
-            players = self._get_players_averages(
+            columns = self._get_players_averages(
                 start_date=start_date,
                 end_date=end_date
             )
-        self._calculate_percentage_impacts(players)
-        self._normalize_stats(players)
-        self._get_relative_value(players)
+        # Positions come back as a list like ["PG", "SG"], but they're only
+        # ever used for membership checks, which are O(1) on a set
+        columns["positions"] = [frozenset(positions) for positions in columns["positions"]]
+
+        stats, stats_matrix = self._get_stats_matrix(columns)
+        normalized_stats = self._normalize_stats(stats_matrix)
+        relative_values = self._get_relative_value(stats, normalized_stats)
+
+        columns.update(zip(stats, normalized_stats.T.tolist()))
+        columns["relative_value"] = relative_values.tolist()
 
-        return players
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
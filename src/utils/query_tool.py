@@ -1,53 +1,313 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Sequence, Iterator, Set
+from contextlib import contextmanager
+from functools import lru_cache
 
-import psycopg2
-from psycopg2.extras import DictCursor
+import csv
+import io
+from psycopg2.extensions import DECIMAL, connection, new_type, register_type
+from psycopg2.extras import execute_batch, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import os
+import threading
+import weakref
+
+# NUMERIC values, like the results of AVG, come back as floats rather than Decimals.
+# Everything they're used for is float arithmetic, and a Decimal is much more expensive to build
+NUMERIC_AS_FLOAT = new_type(
+    DECIMAL.values, "NUMERIC_AS_FLOAT", lambda value, cur: float(value) if value is not None else None
+)
+
+
+class _Connection(connection):
+    """The connections made by the pool, which read NUMERIC values as floats
+
+    The type is only registered on these connections, so any other psycopg2 connection
+    in the same process still gets Decimals
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        register_type(NUMERIC_AS_FLOAT, self)
+
+# The most connections that will be kept open to the database at once
+MAX_CONNECTIONS = 8
+
+# Connections are shared by every QueryTool, and only made the first time one is needed
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+# The names of the statements that have been prepared on each connection. Prepared statements only live
+# as long as their connection, so they're kept by the connection itself, and are forgotten along with it
+# once the pool throws it away. A new connection will have them prepared again the first time they're run
+_prepared_statements: "weakref.WeakKeyDictionary[Any, Set[str]]" = weakref.WeakKeyDictionary()
+_prepared_statements_lock = threading.Lock()
 
 
 class QueryTool:
     """Class to facilitate interactions with the PostgreSQL database in which all the data is stored"""
 
+    def __init__(self):
+        # The connection of the transaction that's currently open, if there is one
+        self._transaction_conn = None
+
     @staticmethod
+    @lru_cache(maxsize=1)
     def _get_connection_params() -> List[str]:
         """Gets the connection information for the NBA database
 
+        The pgpass file is only read the first time, since it isn't going to change while we're running
+
         :return: The connection information for the NBA database
         """
         home_dir = os.getenv("HOME")
         with open(f"{home_dir}/.pgpass", 'r') as fp:
             entries = [entry.strip() for entry in fp.readlines()]
 
-        # the second record in the pgpass file is the one for the NBA database
-        return entries[1].split(":")
+        # the second record in the pgpass file is the one for the NBA database.
+        # The password is the last field, so only split off the first four in case it has a colon in it
+        return entries[1].split(":", 4)
+
+    def _get_connection_pool(self) -> ThreadedConnectionPool:
+        """Gets the pool of connections to the database, creating it if it doesn't exist yet
+
+        :return: The connection pool
+        """
+        global _connection_pool
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                host, port, db, user, password = self._get_connection_params()
+                _connection_pool = ThreadedConnectionPool(
+                    1, MAX_CONNECTIONS, dbname=db, user=user, password=password, host=host, port=port,
+                    connection_factory=_Connection
+                )
+
+        return _connection_pool
 
     def _get_connection(self):
-        """Creates the connection to the database
+        """Gets a connection to the database from the connection pool
+
+        Make sure to hand it back with `_release_connection` once you're done with it
 
         :return: The database connection
         """
-        host, port, db, user, password = self._get_connection_params()
-        return psycopg2.connect(dbname=db, user=user, password=password, host=host, port=port)
+        return self._get_connection_pool().getconn()
+
+    def _release_connection(self, conn) -> None:
+        """Returns a connection to the connection pool so that it can be reused
+
+        :param conn: The database connection
+        """
+        self._get_connection_pool().putconn(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Run all the queries made inside the `with` block on a single connection, in a single transaction
+
+        Everything is committed once the block exits, or rolled back if it raises.
+        Nested transactions just join the one that's already open.
+
+        Usage:
+            with query_tool.transaction():
+                query_tool.delete(...)
+                query_tool.insert(...)
+        """
+        if self._transaction_conn is not None:
+            yield
+            return
+
+        conn = self._get_connection()
+        self._transaction_conn = conn
+        try:
+            yield
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._transaction_conn = None
+            self._release_connection(conn)
 
-    def insert(self, query, values=None) -> None:
+    @contextmanager
+    def _cursor(self, cursor_factory=None, name: str = None):
+        """Get a cursor for running a single query
+
+        Inside of a `transaction` the cursor belongs to the transaction's connection, and committing
+        is left to the transaction. Otherwise a connection is taken from the pool and committed once the query is done
+
+        :param cursor_factory: The type of cursor you want, i.e. `DictCursor`
+        :param name: If provided, the cursor is a server-side cursor with this name, so the results
+            stay on the server until they're fetched
+        :return: The database cursor
+        """
+        if self._transaction_conn is not None:
+            with self._transaction_conn.cursor(name=name, cursor_factory=cursor_factory) as cur:
+                yield cur
+            return
+
+        conn = self._get_connection()
+        try:
+            with conn.cursor(name=name, cursor_factory=cursor_factory) as cur:
+                yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._release_connection(conn)
+
+    def insert(self, query, values=None, page_size: int = 500) -> None:
         """Runs an insert query against the database
 
-        Also can be used for "upsert" queries
+        Also can be used for "upsert" queries. If a list of values is provided, the rows
+        are sent in batches of `page_size` statements per round trip rather than one at a time.
+        For plain inserts, `insert_values` is faster still since it folds each page into a single statement.
 
         :param query: The query you want to run
         :param values: The values that will be inserted into the database
+        :param page_size: The number of rows sent to the server per round trip when values is a list
         """
         if values is None:
             values = {}
 
-        with self._get_connection() as conn:
-            with conn.cursor() as cur:
-                if type(values) == list:
-                    cur.executemany(query, values)
-                else:
-                    cur.execute(query, values)
+        with self._cursor() as cur:
+            if isinstance(values, list):
+                execute_batch(cur, query, values, page_size=page_size)
+            else:
+                cur.execute(query, values)
+
+    def insert_values(self, query: str, values: List[Dict[str, Any]], template: str, page_size: int = 1000) -> None:
+        """Runs a multi-row insert query against the database
+
+        Unlike `insert`, which sends one statement per row, this folds the rows into
+        `INSERT ... VALUES (...), (...), ...` statements of up to `page_size` rows each.
+        Also can be used for `UPDATE ... FROM (VALUES %s)` queries
+
+        :param query: The query you want to run. Must contain a single `VALUES %s` placeholder
+        :param values: The values that will be inserted into the database
+        :param template: The template for a single row of values, like `(%(player_id)s, %(team_id)s)`
+        :param page_size: The maximum number of rows folded into a single statement
+        """
+        with self._cursor() as cur:
+            execute_values(cur, query, values, template=template, page_size=page_size)
+
+    @staticmethod
+    def _to_copy_value(value: Any) -> Any:
+        """Convert a value into the form COPY expects it in
+
+        :param value: The value being loaded
+        :return: NULL for None, a postgres array literal for a list, otherwise the value as is
+        """
+        if value is None:
+            return r"\N"
+        if isinstance(value, list):
+            return QueryTool._to_array_literal(value)
+        return value
+
+    @staticmethod
+    def _to_array_literal(values: Sequence[Any]) -> str:
+        """Convert a list of values into a postgres array literal, like `{"1","2","3"}`
 
-                conn.commit()
+        Postgres parses it into whatever type of array it's used as
+
+        :param values: The values that go in the array
+        :return: The array literal
+        """
+        elements = (str(value).replace("\\", "\\\\").replace('"', '\\"') for value in values)
+        return "{" + ",".join(f'"{element}"' for element in elements) + "}"
+
+    def copy(self, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]]) -> None:
+        """Bulk load rows into a table with COPY FROM STDIN
+
+        The rows are written to an in-memory CSV buffer and streamed to the server
+        in a single command, which is much faster than `insert` for large loads.
+        Only use this for plain inserts, since COPY can't handle conflicts.
+
+        :param table: The table you want to load the rows into
+        :param columns: The columns being loaded, in the same order as the values in each row
+        :param rows: The rows that will be loaded into the table
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([self._to_copy_value(value) for value in row])
+        buffer.seek(0)
+
+        query = f"COPY {table}({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N');"
+        with self._cursor() as cur:
+            cur.copy_expert(query, buffer)
+
+    @contextmanager
+    def staging_table(
+            self,
+            name: str,
+            definition: str,
+            columns: Sequence[str],
+            rows: Iterable[Sequence[Any]]
+    ) -> Iterator[None]:
+        """Copy rows into a temporary table that only exists for the `with` block
+
+        Everything inside the block runs in the same transaction, so the staging table
+        can be read from just like any other table to build the real one.
+
+        Usage:
+            with query_tool.staging_table("stg_players", "LIKE players", columns, rows):
+                query_tool.insert("INSERT INTO players SELECT * FROM stg_players ...")
+
+        :param name: The name of the staging table
+        :param definition: The column definitions of the staging table, i.e. `LIKE players INCLUDING DEFAULTS`
+        :param columns: The columns being loaded, in the same order as the values in each row
+        :param rows: The rows that will be loaded into the staging table
+        """
+        with self.transaction():
+            with self._cursor() as cur:
+                cur.execute(f"CREATE TEMP TABLE {name} ({definition}) ON COMMIT DROP;")
+            self.copy(name, columns, rows)
+            yield
+            # The transaction might go on to load more tables, so the staging table is cleaned up now
+            with self._cursor() as cur:
+                cur.execute(f"DROP TABLE {name};")
+
+    @staticmethod
+    def _dedupe_rows(rows: Iterable[Sequence[Any]], key_indexes: Sequence[int]) -> List[Sequence[Any]]:
+        """Drop the rows that have the same key as a later row
+
+        :param rows: The rows to dedupe
+        :param key_indexes: The positions of the key's values in each row
+        :return: The last row for each key, in the order each key was first seen
+        """
+        deduped = {}
+        for row in rows:
+            deduped[tuple(row[index] for index in key_indexes)] = row
+        return list(deduped.values())
+
+    def upsert(
+            self,
+            table: str,
+            columns: Sequence[str],
+            conflict_columns: Sequence[str],
+            rows: Iterable[Sequence[Any]]
+    ) -> None:
+        """Bulk insert or update rows in a table
+
+        The rows are copied into a temporary staging table and then merged into the table with
+        a single `INSERT ... SELECT ... ON CONFLICT` statement, rather than being sent as VALUES lists.
+
+        :param table: The table you want to load the rows into
+        :param columns: The columns being loaded, in the same order as the values in each row
+        :param conflict_columns: The columns of the table's unique key. Every other column is updated on conflict
+        :param rows: The rows that will be loaded into the table. If more than one has the same key, the last one is used
+        """
+        # Postgres won't let a single ON CONFLICT DO UPDATE touch the same row twice,
+        # so only one row per key can make it into the staging table
+        rows = self._dedupe_rows(rows, [columns.index(column) for column in conflict_columns])
+        staging_table = f"stg_{table}"
+        column_list = ", ".join(columns)
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column not in conflict_columns)
+
+        with self.staging_table(staging_table, f"LIKE {table} INCLUDING DEFAULTS", columns, rows):
+            self.insert(
+                f"INSERT INTO {table}({column_list}) SELECT {column_list} FROM {staging_table} "
+                f"ON CONFLICT ({', '.join(conflict_columns)}) DO UPDATE SET {updates};"
+            )
 
     def select(self, query, params=None) -> List[Dict[str, Any]]:
         """Runs a select query against the database
@@ -59,12 +319,95 @@ class QueryTool:
         if params is None:
             params = {}
 
-        with self._get_connection() as conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute(query, params)
-                rows = cur.fetchall()
+        # Plain tuple rows are zipped straight into dicts, instead of first being built into
+        # DictCursor rows and then copied into dicts
+        with self._cursor() as cur:
+            cur.execute(query, params)
+            names = [column.name for column in cur.description]
+            rows = cur.fetchall()
+
+        return [dict(zip(names, row)) for row in rows]
+
+    def select_prepared(self, name: str, query: str, params: Sequence[Any]) -> List[Dict[str, Any]]:
+        """Runs a select query against the database as a server-side prepared statement
+
+        The query is parsed and planned by postgres the first time it's run on a connection,
+        and every run after that just executes the saved plan with the new parameters.
+
+        :param name: The name of the prepared statement. Must be unique to the query
+        :param query: The query you want to run, with $1, $2, ... placeholders instead of %(name)s ones
+        :param params: The values for each of the placeholders, in order
+        :return: The results of the query as a list of dicts
+        """
+        with self._cursor() as cur:
+            self._execute_prepared(cur, name, query, params)
+            names = [column.name for column in cur.description]
+            rows = cur.fetchall()
+
+        return [dict(zip(names, row)) for row in rows]
+
+    def insert_prepared(self, name: str, query: str, columns: Sequence[Sequence[Any]]) -> None:
+        """Runs a multi-row insert query against the database as a server-side prepared statement
+
+        Each column of values is sent as a single postgres array, so the statement is the same
+        no matter how many rows there are and only has to be planned once per connection.
+        The query should turn the arrays back into rows with `UNNEST`, like:
+            INSERT INTO rosters(player_id, team_id) SELECT * FROM UNNEST($1::INTEGER[], $2::INTEGER[])
+
+        :param name: The name of the prepared statement. Must be unique to the query
+        :param query: The query you want to run, with a cast $1, $2, ... placeholder for each column
+        :param columns: The values of each column, in the same order as the placeholders. None can't be used
+        """
+        with self._cursor() as cur:
+            self._execute_prepared(cur, name, query, [self._to_array_literal(column) for column in columns])
+
+    @staticmethod
+    def _execute_prepared(cur, name: str, query: str, params: Sequence[Any]) -> None:
+        """Execute a prepared statement, preparing it first if it hasn't been yet on the cursor's connection
+
+        :param cur: The cursor to execute the statement with
+        :param name: The name of the prepared statement
+        :param query: The query of the prepared statement, with $1, $2, ... placeholders
+        :param params: The values for each of the placeholders, in order
+        """
+        with _prepared_statements_lock:
+            prepared = _prepared_statements.setdefault(cur.connection, set())
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} AS {query}")
+            prepared.add(name)
+
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute(f"EXECUTE {name}({placeholders});", params)
+
+    def select_columns(self, query, params=None, batch_size: int = 1000) -> Dict[str, List[Any]]:
+        """Runs a select query against the database, returning the results column by column
+
+        Useful when the results are going to be turned into arrays, since each column can be handed
+        to numpy as is, instead of being picked back out of a dict for every row.
+        The rows are streamed from a server-side cursor and added to the columns a batch at a time,
+        so the whole result set never has to be held as rows on the client.
+
+        :param query: The query you want to run
+        :param params: Any parameters that you want to use with the query
+        :param batch_size: The number of rows fetched from the server at a time
+        :return: A dict mapping each column name to the list of that column's values, in row order
+        """
+        if params is None:
+            params = {}
+
+        columns = None
+        with self._cursor(name="select_columns") as cur:
+            cur.execute(query, params)
+            for rows in iter(lambda: cur.fetchmany(batch_size), []):
+                if columns is None:
+                    columns = [[] for _ in rows[0]]
+                for column, values in zip(columns, zip(*rows)):
+                    column.extend(values)
+
+            # A server-side cursor only has a description once something has been fetched from it
+            names = [column.name for column in cur.description]
 
-        return [dict(row) for row in rows]
+        return dict(zip(names, columns or [[] for _ in names]))
 
     def delete(self, query, params=None) -> None:
         """Runs a delete query against the database
@@ -75,8 +418,5 @@ class QueryTool:
         if params is None:
             params = {}
 
-        with self._get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, params)
-
-            conn.commit()
+        with self._cursor() as cur:
+            cur.execute(query, params)
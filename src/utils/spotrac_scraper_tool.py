@@ -1,8 +1,8 @@
 """Spotrac is the definitive source of NBA player salaries so that's where we'll get them from"""
 from typing import List, Dict, Any
 
-from bs4 import BeautifulSoup
-
+from lxml import etree
+import lxml.html
 import requests
 
 from src.utils.utils import sanitize_player_name
@@ -12,10 +12,26 @@ import logging
 
 logging.getLogger("chardet.charsetprober").setLevel(logging.INFO)
 
+# Translation table that deletes the '$' and ',' from a salary like '$1,234,567'
+SALARY_CHARS = str.maketrans("", "", "$,")
+
+# Spotrac is served as utf-8, so there's no need for lxml to guess the encoding
+HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+# Every player in the salary table has their name in an h3, and the rows without one are just headers
+SALARY_ROWS = etree.XPath("(//tbody)[1]/tr[.//h3]")
+SALARY_PLAYER_NAME = etree.XPath("string(.//h3)")
+SALARY_AMOUNT = etree.XPath("string(.//span[contains(concat(' ', normalize-space(@class), ' '), ' info ')])")
+
 
 class SpotracScraperTool:
     SPOTRAC_URL = "https://www.spotrac.com"
 
+    def __init__(self):
+        # Reuse the same connection to Spotrac for every request instead of reconnecting each time.
+        # requests already asks for the pages gzipped and decompresses them
+        self.session = requests.Session()
+
     @staticmethod
     def _format_year_for_url(year: int) -> str:
         """Helper function to format the year for the Spotrac URL
@@ -30,7 +46,7 @@ class SpotracScraperTool:
         prev_year = year - 1
         return f"{prev_year}-{str(year)[2:]}"
 
-    def _get_parseable_html(self, url: str) -> BeautifulSoup:
+    def _get_html_tree(self, url: str) -> lxml.html.HtmlElement:
         """Get the HTML for Spotrac's salary list
 
         For reasons I don't totally understand, in order to get all the results
@@ -38,12 +54,12 @@ class SpotracScraperTool:
         call only gets the first 100 results
 
         :param url: The URL for the page with all the NBA salaries
-        :return:
+        :return: The root element of the page
         """
-        response = requests.post(f"{self.SPOTRAC_URL}/{url}", data={"ajax": True, "mobile": False})
+        response = self.session.post(f"{self.SPOTRAC_URL}/{url}", data={"ajax": True, "mobile": False})
         assert response.status_code == 200
 
-        return BeautifulSoup(response.content, features="lxml")
+        return lxml.html.fromstring(response.content, parser=HTML_PARSER)
 
     @staticmethod
     def _convert_salary(salary: str) -> int:
@@ -52,7 +68,8 @@ class SpotracScraperTool:
         :param salary: The string representation of the salary
         :return: The salary as an integer
         """
-        return int(salary.strip().replace("$", "").replace(",", ""))
+        # int() ignores surrounding whitespace, so only the '$' and ',' need to be removed
+        return int(salary.translate(SALARY_CHARS))
 
     def scrape_salaries(self, year: int) -> List[Dict[str, Any]]:
         """Scrape the NBA salaries for the given year from Spotrac
@@ -73,19 +90,14 @@ class SpotracScraperTool:
         year_for_url = self._format_year_for_url(year)
         url = f"/nba/rankings/{year_for_url}/base/"
 
-        html = self._get_parseable_html(url)
-        table_body: BeautifulSoup = html.find('tbody')
-        table_rows = table_body.find_all('tr')
+        tree = self._get_html_tree(url)
 
+        # The table is walked with compiled XPaths in lxml's C code, rather than searched row by row in Python
         salaries = []
-        for row in table_rows:
-            if row.find("h3"):
-                player_name = row.find("h3").text
-                salary_str = row.find("span", {"class": "info"}).text
-                salary = self._convert_salary(salary_str)
-                salaries.append({
-                    "player_name": sanitize_player_name(player_name),
-                    "salary": salary
-                })
+        for row in SALARY_ROWS(tree):
+            salaries.append({
+                "player_name": sanitize_player_name(SALARY_PLAYER_NAME(row)),
+                "salary": self._convert_salary(SALARY_AMOUNT(row))
+            })
 
         return salaries
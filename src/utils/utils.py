@@ -2,6 +2,10 @@
 from unidecode import unidecode
 import re
 
+# Matches the periods and suffixes that get stripped out of player names, so both are removed in a single pass.
+# The suffixes have to end on a word boundary, so that a name that just starts with one, say "Srna", is left alone
+SANITIZE_PATTERN = re.compile(r"\.| Jr\b| IV\b| III\b| II\b| Sr\b")
+
 
 def sanitize_player_name(player_name: str) -> str:
     """Helper function to sanitize player names.
@@ -14,7 +18,4 @@ def sanitize_player_name(player_name: str) -> str:
     :param player_name: The name that you want to sanitize
     :return: The player name modified as described above
     """
-    ascii_characters = unidecode(player_name)
-    without_dots = ascii_characters.replace(".", "")
-    without_suffixes = re.sub(r"( Jr| IV| III| II| Sr)", "", without_dots)
-    return without_suffixes
+    return SANITIZE_PATTERN.sub("", unidecode(player_name))
@@ -1,7 +1,16 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import datetime
+from functools import lru_cache, partial
+import json
 import os
-from typing import List, Dict, Tuple, Union, Any
+import sys
+import threading
+from typing import List, Dict, Iterator, Optional, Set, Tuple, Union, Any
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from yahoo_oauth import OAuth2
+from src.utils.page_cache import get_cached_page
 from src.utils.utils import sanitize_player_name
 
 import logging
@@ -10,32 +19,156 @@ import logging
 logging.getLogger("yahoo_oauth").setLevel(logging.INFO)
 
 
+# The NBA teams whose names on Yahoo don't match their names everywhere else
+NBA_TEAM_NAMES = {"LA Clippers": "Los Angeles Clippers"}
+
+# The most requests that will be made to Yahoo at the same time
+MAX_CONCURRENT_REQUESTS = 8
+
+# Held while the OAuth token is being refreshed
+_TOKEN_REFRESH_LOCK = threading.Lock()
+
+
+def _merge_entries(entries: List[Any]) -> Dict[str, Any]:
+    """Merge the list of entries Yahoo sends for a team or player into a single dict
+
+    Yahoo sends each field as its own little dict, mixed in with some lists, and which fields are
+    there (and so where each one is) changes from team to team and player to player. Merging them
+    means the fields can be looked up by name instead of by where they happen to be
+
+    :param entries: The list of entries for a team or player
+    :return: All the fields from the dict entries
+    """
+    return {
+        key: value
+        for entry in entries if entry.__class__ is dict
+        for key, value in entry.items()
+    }
+
+
+def _mount_adapter(oauth: OAuth2):
+    """Set up the connection pool and retries on the OAuth session's connections to Yahoo
+
+    Keep a connection open to Yahoo for each of the concurrent requests so none of them have to reconnect,
+    and retry the requests that fail because Yahoo is having trouble or rate limiting us
+
+    :param oauth: The OAuth session
+    """
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS, max_retries=retries)
+    oauth.session.mount("https://", adapter)
+
+
+def _refresh_token_if_expiring(oauth: OAuth2):
+    """Refresh the OAuth token, but only if it has expired or is about to
+
+    The check is just against the token time that's already in memory, so it's cheap enough to do
+    before every request. Refreshing writes the new token back to oauth_keys.json
+
+    :param oauth: The OAuth session
+    """
+    if oauth.token_is_valid():
+        return
+
+    # The requests are made from several threads at once, and they'd all find the token expired at the
+    # same time. Only the first one to get the lock refreshes it, and the rest just use the new token
+    with _TOKEN_REFRESH_LOCK:
+        if not oauth.token_is_valid():
+            oauth.refresh_access_token()
+            # Refreshing the token replaces the session, so the adapter has to be mounted on the new one
+            _mount_adapter(oauth)
+
+
+@lru_cache(maxsize=1)
+def _get_oauth() -> OAuth2:
+    """Get the OAuth session for the Yahoo Fantasy API
+
+    It's only created the first time, and then shared by every YahooFantasyApiTool,
+    so oauth_keys.json is only read once a run
+
+    :return: The OAuth session
+    """
+    oauth = OAuth2(None, None, from_file=f"{os.getenv('BBALL_HOME')}/src/yahootils/oauth_keys.json")
+    _mount_adapter(oauth)
+    return oauth
+
+
 class YahooFantasyApiTool:
     YAHOO_API_URL = "https://fantasysports.yahooapis.com/fantasy/v2"
     LEAGUE_ID = "27633"
+    MAX_CONCURRENT_REQUESTS = MAX_CONCURRENT_REQUESTS
+    # Even if you want more than 25 players at a time you can't get more
+    PLAYERS_PER_REQUEST = 25
+    # How long the responses that don't change much are reused before asking Yahoo again.
+    # The rosters aren't cached at all since they can change at any time
+    GAME_CACHE_AGE = datetime.timedelta(days=1)
+    PLAYER_CACHE_AGE = datetime.timedelta(hours=6)
+    MATCH_UP_CACHE_AGE = datetime.timedelta(days=1)
+    # The request for the game ID, shared by every tool
+    _game_id: Optional[Future] = None
 
     def __init__(self):
-        self.oauth = OAuth2(None, None, from_file=f"{os.getenv('BBALL_HOME')}/src/yahootils/oauth_keys.json")
-        if not self.oauth.token_is_valid():
-            self.oauth.refresh_access_token()
-
-        self.game_id = self._get_game_id()
+        self.oauth = _get_oauth()
+
+        # The game ID isn't needed until the first real request, so it's fetched in the background
+        # while whatever is using the tool gets set up, instead of holding up construction.
+        # It's the same for every tool, so it's only fetched again if the last try failed
+        cls = type(self)
+        if cls._game_id is None or (cls._game_id.done() and cls._game_id.exception() is not None):
+            executor = ThreadPoolExecutor(max_workers=1)
+            cls._game_id = executor.submit(self._get_game_id)
+            executor.shutdown(wait=False)
+
+    @property
+    def game_id(self) -> str:
+        """The Yahoo game ID, waiting for the request for it to finish if it hasn't yet"""
+        return self._game_id.result()
+
+    def _download_from_yahoo(self, url: str) -> Dict[str, Any]:
+        """Make a get request to the Yahoo Fantasy API
+
+        :param url: The full URL of the endpoint from which you want to retrieve data
+        :return: The data from your request
+        """
+        _refresh_token_if_expiring(self.oauth)
+        response = self.oauth.session.get(url=url, params={"format": "json"})
+        # The body is only decoded once, even when it's needed again for the error message
+        content = response.json()
+        data = content.get("fantasy_content")
+        if not data:
+            raise Exception(f"Unable to retrieve data from Yahoo because: {content}")
+        else:
+            return data
 
-    def _make_request_to_yahoo(self, endpoint: str) -> Dict[str, Any]:
+    def _make_request_to_yahoo(self, endpoint: str, max_age: Optional[datetime.timedelta] = None) -> Dict[str, Any]:
         """Helper function for making get requests to the Yahoo Fantasy API
 
         :param endpoint: The endpoint from which you want to retrieve data
+        :param max_age: If given, the data is cached on disk and reused until it's this old,
+            instead of asking Yahoo for it again. Only the successful requests are cached
         :return: The data from your request
         """
-        response = self.oauth.session.get(
-            url=f"{self.YAHOO_API_URL}/{endpoint}",
-            params={"format": "json"}
-        )
-        data = response.json().get("fantasy_content")
-        if not data:
-            raise Exception(f"Unable to retrieve data from Yahoo because: {response.json()}")
-        else:
-            return data
+        url = f"{self.YAHOO_API_URL}/{endpoint}"
+        if max_age is None:
+            return self._download_from_yahoo(url)
+
+        cached = get_cached_page(url, lambda: json.dumps(self._download_from_yahoo(url)).encode("utf-8"), max_age)
+        return json.loads(cached)
+
+    def _make_requests_to_yahoo(
+            self, endpoints: List[str], max_age: Optional[datetime.timedelta] = None
+    ) -> List[Dict[str, Any]]:
+        """Helper function for making several get requests to the Yahoo Fantasy API at once
+
+        The requests are almost entirely spent waiting on Yahoo, so they're all sent
+        at the same time instead of one after another
+
+        :param endpoints: The endpoints from which you want to retrieve data
+        :param max_age: How long the data from each request can be cached for, like in _make_request_to_yahoo
+        :return: The data from each request, in the same order as the endpoints
+        """
+        with ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_REQUESTS) as executor:
+            return list(executor.map(partial(self._make_request_to_yahoo, max_age=max_age), endpoints))
 
     def _get_game_id(self) -> str:
         """Get the Yahoo game ID
@@ -44,7 +177,7 @@ class YahooFantasyApiTool:
 
         :return: The game ID
         """
-        data = self._make_request_to_yahoo("game/nba")
+        data = self._make_request_to_yahoo("game/nba", max_age=self.GAME_CACHE_AGE)
         return data["game"][0]["game_id"]
 
     @staticmethod
@@ -54,13 +187,11 @@ class YahooFantasyApiTool:
         :param team_dict: The dict containing all the information about the fantasy team
         :return: A dict with the team_id, team_name, and manager name
         """
-        team_id = team_dict[1]["team_id"]
-        team_name = team_dict[2]["name"]
-        manager = team_dict[19]["managers"][0]["manager"]["nickname"]
+        team_data = _merge_entries(team_dict)
         return {
-            "team_id": team_id,
-            "team_name": team_name,
-            "manager": manager
+            "team_id": team_data["team_id"],
+            "team_name": team_data["name"],
+            "manager": team_data["managers"][0]["manager"]["nickname"]
         }
 
     @staticmethod
@@ -76,10 +207,11 @@ class YahooFantasyApiTool:
                 ...
             ]
         """
-        roster_dict.pop("count")
+        # The count may already have been taken out if the players on the roster were parsed too
+        roster_dict.pop("count", None)
         roster = []
         for _, player in roster_dict.items():
-            player_id = player["player"][0][1]["player_id"]
+            player_id = _merge_entries(player["player"][0])["player_id"]
             roster.append({
                 "team_id": team_id,
                 "player_id": player_id
@@ -107,6 +239,35 @@ class YahooFantasyApiTool:
                     ...
                 ]
         """
+        return self._walk_teams_and_rosters()
+
+    def get_teams_rosters_and_players(
+            self
+    ) -> Tuple[List[Dict[str, str]], List[Dict[str, str]], List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Get the Fantasy Teams, their rosters, and the rostered players and their NBA teams
+
+        The teams/players endpoint already has everything about the players on the rosters,
+        so they all come from the one request, instead of having to be found in the whole player pool.
+        Every rostered player is included whatever their status, so the rosters never refer to a player
+        that isn't in the players list
+
+        :return: Four lists of dicts, the teams and rosters like the ones from get_teams_and_rosters,
+            and the players and NBA teams like the ones from get_players_and_nba_teams
+        """
+        players = []
+        nba_teams = []
+        teams, rosters = self._walk_teams_and_rosters(players, nba_teams)
+        return teams, rosters, players, nba_teams
+
+    def _walk_teams_and_rosters(
+            self, players: Optional[List] = None, nba_teams: Optional[List] = None
+    ) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+        """Get the Fantasy Teams and their rosters, and optionally the rostered players too
+
+        :param players: If given, the list to which the rostered players will be added
+        :param nba_teams: The list to which the rostered players' NBA teams will be added. Needed if players is given
+        :return: The teams and rosters, like the ones from get_teams_and_rosters
+        """
         data = self._make_request_to_yahoo(f"league/{self.game_id}.l.{self.LEAGUE_ID}/teams/players")
         teams_dict = data["league"][1]["teams"]
         # keeping this key in the dict messes up the loop below, and we don't need it anyway
@@ -114,12 +275,17 @@ class YahooFantasyApiTool:
 
         teams = []
         rosters = []
+        nba_team_ids = set()
         for _, team in teams_dict.items():
             # the data structure from the API is very strange, hence all this un-nesting
             team_dict = team["team"][0]
             team_info = self._get_team_info(team_dict)
             roster_dict = team["team"][1]["players"]
 
+            # The roster's players are laid out just like a batch from the players endpoint
+            if players is not None:
+                self._get_batch_of_players(roster_dict, players, nba_teams, nba_team_ids, include_unavailable=True)
+
             team_id = team_info["team_id"]
             roster_info = self._get_player_ids_for_roster(team_id, roster_dict)
 
@@ -128,42 +294,51 @@ class YahooFantasyApiTool:
 
         return teams, rosters
 
-    def _get_batch_of_players(self, players: List, nba_teams: List, start: int = 0) -> None:
-        """Get a batch of players from the Yahoo Fantasy API.
+    @staticmethod
+    def _get_batch_of_players(
+            players_dict: Union[Dict[str, Any], List],
+            players: List,
+            nba_teams: List,
+            nba_team_ids: Set[int],
+            include_unavailable: bool = False
+    ) -> int:
+        """Parse a batch of players from the Yahoo Fantasy API.
 
         Add the batch to the players list and also add the players' teams to the nba_teams
         list if that team isn't already in there
 
-        Apparently 25 players is the most you can get in a single request.
-
+        :param players_dict: The players from a request to the league's players endpoint,
+            or the players on one team's roster from the teams/players endpoint
         :param players: The list to which the players will be added
         :param nba_teams: The list to which the NBA team will be added
-        :param start: The index in the list of all possible players where the request should start
-
+        :param nba_team_ids: The IDs of the teams already in nba_teams
+        :param include_unavailable: Whether to keep the players whose status is NA, who are skipped by default
+        :return: The number of players in the batch
         """
-        # even if you want more than 25 players at a time you can't get more
-        endpoint = f"league/{self.game_id}.l.{self.LEAGUE_ID}/players;start={start};count=25"
-        data = self._make_request_to_yahoo(endpoint)
+        # Past the last player Yahoo sends back an empty list instead of a batch
+        if not players_dict:
+            return 0
 
-        num_results = data["league"][1]["players"].pop("count")
+        num_results = players_dict.pop("count")
 
-        for _, player_dict in data["league"][1]["players"].items():
+        for _, player_dict in players_dict.items():
             # We need to merge all the dicts because they're not going to be the same
             # for each player. For example, if a player is injured they have an extra
             # dict with their injury status
-            player_data = {}
-            for entry in player_dict["player"][0]:
-                if type(entry) == dict:
-                    player_data.update(entry)
+            player_data = _merge_entries(player_dict["player"][0])
 
             status = player_data.get("status")
-            if status == "NA":
+            if status == "NA" and not include_unavailable:
                 continue
 
             player_id = int(player_data["player_id"])
             player_name = f"{player_data['name']['ascii_first']} {player_data['name']['ascii_last']}"
 
-            positions = player_data["display_position"].split(",")
+            # The statuses and positions are the same handful of strings over and over,
+            # so they're interned to share one copy of each instead of one per player
+            if status is not None:
+                status = sys.intern(status)
+            positions = [sys.intern(position) for position in player_data["display_position"].split(",")]
 
             team_id = int(player_data.get("editorial_team_key", "").split(".")[-1])
             team_name = player_data.get("editorial_team_full_name")
@@ -177,24 +352,23 @@ class YahooFantasyApiTool:
                 "team_id": team_id
             })
 
-            if team_id not in [team["team_id"] for team in nba_teams]:
+            if team_id not in nba_team_ids:
+                nba_team_ids.add(team_id)
                 nba_teams.append({
                     "team_id": team_id,
-                    "team_name": team_name.replace("LA Clippers", "Los Angeles Clippers"),
+                    "team_name": NBA_TEAM_NAMES.get(team_name, team_name),
                     "team_code": team_code
                 })
 
-        # If a full batch was returned that means there are more players to pull still
-        if num_results == 25:
-            self._get_batch_of_players(
-                players=players,
-                nba_teams=nba_teams,
-                start=start + 25
-            )
+        return num_results
 
-    def get_players_and_nba_teams(self) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    def get_players_and_nba_teams(
+            self, max_age: Optional[datetime.timedelta] = PLAYER_CACHE_AGE
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
         """Get all the players and their teams
 
+        :param max_age: How long the cached pages of players can be reused for. Pass a timedelta of 0
+            when the statuses have to be up to date, to always ask Yahoo for them
         :return: Two lists of dicts, one of the players and one of the NBA teams.
             The players list looks like:
                 [
@@ -211,12 +385,45 @@ class YahooFantasyApiTool:
                     ...
                 ]
         """
-        players = []
         nba_teams = []
-        self._get_batch_of_players(players, nba_teams)
-
+        players = list(self.iter_players(nba_teams, max_age=max_age))
         return players, nba_teams
 
+    def iter_players(
+            self, nba_teams: List[Dict[str, Any]], max_age: Optional[datetime.timedelta] = PLAYER_CACHE_AGE
+    ) -> Iterator[Dict[str, Any]]:
+        """Iterate over all the players, one batch at a time as Yahoo sends them back
+
+        So something that works on the players one at a time doesn't have to wait for, or hold on to,
+        the whole player pool. The players' teams are collected along the way, but nba_teams only has
+        all of them once all the players have been iterated over
+
+        :param nba_teams: The list to which the players' NBA teams will be added,
+            like the one from get_players_and_nba_teams
+        :param max_age: How long the cached pages of players can be reused for, like in get_players_and_nba_teams
+        :return: A generator of the players, like the ones from get_players_and_nba_teams
+        """
+        nba_team_ids = {team["team_id"] for team in nba_teams}
+        # Apparently 25 players is the most you can get in a single request, so rather than waiting on
+        # each batch before asking for the next, several batches are requested at once
+        start = 0
+        while True:
+            end = start + self.PLAYERS_PER_REQUEST * self.MAX_CONCURRENT_REQUESTS
+            starts = range(start, end, self.PLAYERS_PER_REQUEST)
+            endpoints = [
+                f"league/{self.game_id}.l.{self.LEAGUE_ID}/players;start={batch_start};count={self.PLAYERS_PER_REQUEST}"
+                for batch_start in starts
+            ]
+            for data in self._make_requests_to_yahoo(endpoints, max_age=max_age):
+                players = []
+                num_results = self._get_batch_of_players(data["league"][1]["players"], players, nba_teams, nba_team_ids)
+                yield from players
+                # Anything less than a full batch means that was the last of the players
+                if num_results < self.PLAYERS_PER_REQUEST:
+                    return
+
+            start = end
+
     def get_match_ups(self, team_id: Union[str, int]) -> List[Dict[str, str]]:
         """Get all the match ups for the specified team
 
@@ -236,7 +443,10 @@ class YahooFantasyApiTool:
             ]
 
         """
-        data = self._make_request_to_yahoo(f"team/{self.game_id}.l.{self.LEAGUE_ID}.t.{team_id}/matchups")
+        data = self._make_request_to_yahoo(
+            f"team/{self.game_id}.l.{self.LEAGUE_ID}.t.{team_id}/matchups",
+            max_age=self.MATCH_UP_CACHE_AGE
+        )
         match_ups = data["team"][1]["matchups"]
         match_ups.pop("count")
 
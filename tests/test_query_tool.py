@@ -0,0 +1,32 @@
+from contextlib import contextmanager
+import unittest
+from unittest import mock
+
+from src.utils.query_tool import QueryTool
+
+
+class UpsertTest(unittest.TestCase):
+    def test_duplicate_keys_only_stage_the_last_row(self):
+        query_tool = QueryTool()
+        staged = []
+
+        @contextmanager
+        def staging_table(name, definition, columns, rows):
+            staged.extend(rows)
+            yield
+
+        rows = [
+            (1, "Michael Jordan", "O"),
+            (2, "Scottie Pippen", None),
+            (1, "Michael Jordan", None),
+        ]
+        with mock.patch.object(query_tool, "staging_table", staging_table), \
+                mock.patch.object(query_tool, "insert") as insert:
+            query_tool.upsert("players", ("player_id", "player_name", "status"), ("player_id",), rows)
+
+        self.assertEqual(staged, [(1, "Michael Jordan", None), (2, "Scottie Pippen", None)])
+        insert.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()